@@ -1,3 +1,4 @@
 # License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
 
-from . import af_appointment
\ No newline at end of file
+from . import af_appointment
+from . import calendar
@@ -20,21 +20,29 @@
 ##############################################################################
 
 from odoo import models, fields, api, _
-from datetime import datetime
+from datetime import datetime, time
 import pytz
-from urllib import request
 from urllib.error import URLError, HTTPError
-import json
 import logging
 from odoo.exceptions import Warning
 
-# TODO: only use this in remote tests
-import ssl
-
 _logger = logging.getLogger(__name__)
 
 LOCAL_TZ = 'Europe/Stockholm'
 
+_local_tz = pytz.timezone(LOCAL_TZ)
+
+def _local_to_utc(local_datetime, offsets):
+    """Converts a naive local time to naive UTC. Schedules lie within
+    office hours, so one UTC offset per day is looked up and memoized.
+    :param offsets: a dict memoizing the UTC offset per date.
+    """
+    day = local_datetime.date()
+    offset = offsets.get(day)
+    if offset is None:
+        offset = offsets[day] = _local_tz.utcoffset(datetime.combine(day, time(12)))
+    return local_datetime - offset
+
 class AfAppointment(models.Model):
     _name = "af.appointment"
     _description = "Integration helper class"
@@ -44,15 +52,6 @@ class AfAppointment(models.Model):
         tracking_id = "%s-%s-%s" % (af_system_id.upper(), af_environment.upper(), tracking_number)
         return tracking_id
 
-    def _generate_ctx(self, is_remote):
-        ctx = ssl.create_default_context()
-        if is_remote:
-            ctx.check_hostname = False
-            ctx.verify_mode = ssl.CERT_NONE
-        else:
-            pass # TODO: implement mTSL here?
-        return ctx
-
     def _generate_headers(self, af_environment, af_system_id, af_tracking_id):
         get_headers = {
             'AF-Environment': af_environment,
@@ -63,18 +62,13 @@ class AfAppointment(models.Model):
 
     # /bookable-occasions
     def get_occasions(self, from_date, to_date, appointment_channel, appointment_type, max_depth = False, appointment_length = False, location_code = False, profession_id = False, employee_user_id = False):
-        client_id = self.env['ir.config_parameter'].sudo().get_param('af_rest.client_id')
-        client_secret = self.env['ir.config_parameter'].sudo().get_param('af_rest.client_secret')
-        af_environment = self.env['ir.config_parameter'].sudo().get_param('af_rest.af_environment')
-        af_port = self.env['ir.config_parameter'].sudo().get_param('af_rest.ipf_port')
-        af_url = self.env['ir.config_parameter'].sudo().get_param('af_rest.ipf_url')
-        af_system_id = self.env['ir.config_parameter'].sudo().get_param('af_rest.af_system_id')
-
-        if not (af_url or af_port or client_id or client_secret or af_environment or af_system_id):
+        config = self.env['af.ipf.client']._get_ipf_config()
+
+        if not (config.url or config.port or config.client_id or config.client_secret or config.environment or config.system_id):
             raise Warning('Please setup AF integrations')
 
         # Generate a tracking-id
-        af_tracking_id = self._generate_tracking_id(af_system_id, af_environment)
+        af_tracking_id = self._generate_tracking_id(config.system_id, config.environment)
 
         # Define base url
         # ex: https://ipfapi.arbetsformedlingen.se:443/appointments/v1/bookable-occasions?appointment_type=1&appointment_channel=SPD&from_date=2020-03-20&to_date=2020-03-21&client_id=da03472cd17e4ce4bb2d017156db7156&client_secret=B4BC32F21a314Cb9B48877989Cc1e3b8
@@ -82,11 +76,11 @@ class AfAppointment(models.Model):
 
         # Insert values into base_url
         get_url = base_url.format(
-            url = af_url, # https://ipfapi.arbetsformedlingen.se
-            port = af_port, # 443
+            url = config.url, # https://ipfapi.arbetsformedlingen.se
+            port = config.port, # 443
             path = "appointments/v1/bookable-occasions", # TODO: remove hardcoding?
-            client = client_id, # check in anypoint for example
-            secret = client_secret, # check in anypoint for example
+            client = config.client_id, # check in anypoint for example
+            secret = config.client_secret, # check in anypoint for example
             from_date_str = from_date.strftime("%Y-%m-%d"), # 2020-03-17
             to_date_str = to_date.strftime("%Y-%m-%d"), # 2020-03-25
             appointment_channel_str = appointment_channel, # 'SPD'
@@ -110,23 +104,16 @@ class AfAppointment(models.Model):
         #   33 - fördjupat
 
         # Generate headers for our get
-        get_headers = self._generate_headers(af_environment, af_system_id, af_tracking_id)
-
-        # Build our request using url and headers
-        # Request(url, data=None, headers={}, origin_req_host=None, unverifiable=False, method=None)
-        req = request.Request(url=get_url, headers=get_headers)
+        get_headers = self._generate_headers(config.environment, config.system_id, af_tracking_id)
 
-        ctx = self._generate_ctx(True) # TODO: change to False
-
-        # send GET and read result
-        res_json = request.urlopen(req, context=ctx).read()
-        # Convert json to python format: https://docs.python.org/3/library/json.html#json-to-py-table 
-        res = json.loads(res_json)
+        # send GET over a pooled connection and read result
+        res = self.env['af.ipf.client'].ipf_get(get_url, get_headers, is_remote=True) # TODO: change to False
 
         # get list of occasions from res
         occasions = res.get('bookable_occasions')
 
-        # loop over list
+        # collect values per ipf id
+        occasion_vals = {}
         for occasion in occasions:
             date = occasion.get('occasion_date')
             stop = occasion.get('occasion_end_time')
@@ -136,37 +123,48 @@ class AfAppointment(models.Model):
             start_datetime = datetime.strptime((date + "T" + start), "%Y-%m-%dT%H:%M")
 
             occ_id = occasion.get('id')
-            occ = self.env['calendar.occasion'].search([('ipf_id', '=', occ_id)])
-            if occ:
-                # Update existing 'occ'
-                pass
-            else:
-                vals = {
-                    'ipf_id': occ_id,
-                    'name': occ_id,
-                    'stop': stop_datetime,
-                    'start': start_datetime,
-                    'duration': (stop_datetime - start_datetime).seconds//60 # get length in minutes
-                    # TODO: implement these
-                    # '': occasion.get('appointment_channel'),
-                    # '': occasion.get('occasion_status_id'),
-                }
-                self.env['calendar.occasion'].create(vals)
+            occasion_vals[occ_id] = {
+                'ipf_id': occ_id,
+                'name': occ_id,
+                'stop': stop_datetime,
+                'start': start_datetime,
+                'duration': (stop_datetime - start_datetime).seconds//60 # get length in minutes
+                # TODO: implement these
+                # '': occasion.get('appointment_channel'),
+                # '': occasion.get('occasion_status_id'),
+            }
+
+        self._upsert_occasions(occasion_vals)
+
+    def _upsert_occasions(self, occasion_vals):
+        """Creates or updates imported occasions with one search, one
+        create and one write per distinct set of changed values.
+        :param occasion_vals: a dict mapping ipf id to occasion values.
+        :returns: the created and updated occasions.
+        """
+        res = self.env['calendar.occasion']
+        if not occasion_vals:
+            return res
+        occasion_vals = dict(occasion_vals)
+        changes = []
+        for occ in self.env['calendar.occasion'].search([('ipf_id', 'in', list(occasion_vals))]):
+            changes.append((occ, occasion_vals.pop(occ.ipf_id)))
+        # occasions that have been archived are not imported again
+        for ipf_id in self._get_archived_ipf_ids('calendar.occasion.archive', list(occasion_vals)):
+            del occasion_vals[ipf_id]
+        res |= self._write_changed_vals('calendar.occasion', changes)
+        res |= self.env['calendar.occasion'].create(list(occasion_vals.values()))
+        return res
 
     # /appointments
     def get_appointments(self, from_date, to_date, user = '', pnr = '', appointment_types = [], status_list = []):
-        client_id = self.env['ir.config_parameter'].sudo().get_param('af_rest.client_id')
-        client_secret = self.env['ir.config_parameter'].sudo().get_param('af_rest.client_secret')
-        af_environment = self.env['ir.config_parameter'].sudo().get_param('af_rest.af_environment')
-        af_port = self.env['ir.config_parameter'].sudo().get_param('af_rest.ipf_port')
-        af_url = self.env['ir.config_parameter'].sudo().get_param('af_rest.ipf_url')
-        af_system_id = self.env['ir.config_parameter'].sudo().get_param('af_rest.af_system_id')
-
-        if not (af_url or af_port or client_id or client_secret or af_environment or af_system_id):
+        config = self.env['af.ipf.client']._get_ipf_config()
+
+        if not (config.url or config.port or config.client_id or config.client_secret or config.environment or config.system_id):
             raise Warning('Please setup AF integrations')
 
         # Generate a tracking-id
-        af_tracking_id = self._generate_tracking_id(af_system_id, af_environment)
+        af_tracking_id = self._generate_tracking_id(config.system_id, config.environment)
 
         # Define base url
         # ex: https://ipfapi.arbetsformedlingen.se:443/appointments/v1/appointments?client_id=da03472cd17e4ce4bb2d017156db7156&client_secret=B4BC32F21a314Cb9B48877989Cc1e3b8&from_date=2010-10-01&pnr=199601265516
@@ -174,11 +172,11 @@ class AfAppointment(models.Model):
 
         # Insert values into base_url
         get_url = base_url.format(
-            url = af_url, # https://ipfapi.arbetsformedlingen.se
-            port = af_port, # 443
+            url = config.url, # https://ipfapi.arbetsformedlingen.se
+            port = config.port, # 443
             path = "appointments/v1/appointments", # TODO: remove hardcoding?
-            client = client_id, # check in anypoint for example
-            secret = client_secret, # check in anypoint for example
+            client = config.client_id, # check in anypoint for example
+            secret = config.client_secret, # check in anypoint for example
             from_date_str = from_date.strftime("%Y-%m-%d"), # 2020-03-17
             to_date_str = to_date.strftime("%Y-%m-%d"), # 2020-03-25
             user_str = ("&user_id=%s" % user) if user else '', # 'eridd'
@@ -188,25 +186,35 @@ class AfAppointment(models.Model):
         )
 
         # Generate headers for our get
-        get_headers = self._generate_headers(af_environment, af_system_id, af_tracking_id)
-
-        # Build our request using url and headers
-        # Request(url, data=None, headers={}, origin_req_host=None, unverifiable=False, method=None)
-        req = request.Request(url=get_url, headers=get_headers)
-
-        ctx = self._generate_ctx(is_remote=True) # TODO: change to False
+        get_headers = self._generate_headers(config.environment, config.system_id, af_tracking_id)
 
-        # send GET and read result
-        res_json = request.urlopen(req, context=ctx).read()
-        # Convert json to python format: https://docs.python.org/3/library/json.html#json-to-py-table 
-        res = json.loads(res_json)
+        # send GET over a pooled connection and read result
+        res = self.env['af.ipf.client'].ipf_get(get_url, get_headers, is_remote=True) # TODO: change to False
 
         # get list of appointments
         appointments = res.get("appointments")
 
-        # loop over list
+        # resolve customers, case workers and existing appointments with one query each
+        customer_ids = list({appointment.get('customer_id') for appointment in appointments if appointment.get('customer_id')})
+        signatures = list({appointment.get('employee_signature') for appointment in appointments if appointment.get('employee_signature')})
+        partners = {}
+        for partner in self.env['res.partner'].search([('customer_id', 'in', customer_ids)]):
+            partners[partner.customer_id] = partners.get(partner.customer_id, self.env['res.partner']) | partner
+        users = {}
+        # signature is the html email signature, case workers are found by af_signature
+        for user in self.env['res.users'].search([('af_signature', 'in', signatures)]):
+            users[user.af_signature] = users.get(user.af_signature, self.env['res.users']) | user
+        apps = {app.ipf_id: app for app in self.env['calendar.appointment'].search([('ipf_id', 'in', [appointment.get('id') for appointment in appointments])])}
+        archived = self._get_archived_ipf_ids('calendar.appointment.archive',
+            [appointment.get('id') for appointment in appointments if appointment.get('id') not in apps])
+
+        vals_list = []
+        changes = []
         for appointment in appointments:
             app_id = appointment.get('id')
+            if app_id in archived:
+                # archived appointments are not imported again
+                continue
             date = appointment.get('appointment_date') # "2019-10-02"
             stop = appointment.get('appointment_end_time') # "12:30:00"
             start = appointment.get('appointment_start_time') # "12:00:00"
@@ -214,32 +222,35 @@ class AfAppointment(models.Model):
             stop_datetime = datetime.strptime((date + "T" + stop), "%Y-%m-%dT%H:%M:%S")
             start_datetime = datetime.strptime((date + "T" + start), "%Y-%m-%dT%H:%M:%S")
 
-            partner = self.env['res.partner'].search(['customer_id', '=', (appointment.get('customer_id'))]) # TODO: change to customer_id?
-            user = self.env['res.users'].search([('signature', '=', appointment.get('employee_signature'))])
-            
+            partner = partners.get(appointment.get('customer_id'), self.env['res.partner'])
+            user = users.get(appointment.get('employee_signature'), self.env['res.users'])
+
+            vals = {
+                'ipf_id': app_id,
+                'name': appointment.get('appointment_title'),
+                'start': start_datetime,
+                'stop': stop_datetime,
+                'duration': appointment.get('appointment_length'),
+                'app_type': appointment.get('appointment_type'),
+                'status': appointment.get('status'),
+                'location_code': appointment.get('location_code'),
+                'office_code': appointment.get('office_code'),
+                'channel': appointment.get('appointment_channel'),
+            }
+            # keep the current case worker and customer if they could not be resolved
+            if user:
+                vals['user_id'] = [(6, 0, user.ids)]
+            if partner:
+                vals['partner_id'] = [(6, 0, partner.ids)]
+
             # check if appointment exists
-            app = self.env['calendar.appointment'].search([('ipf_id', '=', app_id)])
+            app = apps.get(app_id)
             if app:
-                _logger.warn("DAER: app exists! app_id: %s app.channel: %s app: %s" % (app.id, app.channel, app))
-                # TODO: update existing appointment
-                pass
+                # update existing appointment if anything has changed
+                changes.append((app, vals))
             else:
                 # create new appointment
-                vals = {
-                    'ipf_id': app_id,
-                    'name': appointment.get('appointment_title'),
-                    # 'user_id': user.id, # disabled because of testing TODO: re-add
-                    # 'partner_id': partner.id, # disabled because of testing TODO: re-add
-                    'start': start_datetime,
-                    'stop': stop_datetime,
-                    'duration': appointment.get('appointment_length'),
-                    'app_type': appointment.get('appointment_type'),
-                    'status': appointment.get('status'),
-                    'location_code': appointment.get('location_code'),
-                    'office_code': appointment.get('office_code'),
-                    'channel': appointment.get('appointment_channel'),
-                }
-                self.env['calendar.appointment'].create(vals)
+                vals_list.append(vals)
 
             # Unused values from appointment:
             # appointment.get('customer_name')
@@ -248,17 +259,65 @@ class AfAppointment(models.Model):
             # appointment.get('office_address')
             # appointment.get('office_name')
 
+        self._write_changed_vals('calendar.appointment', changes)
+        self.env['calendar.appointment'].create(vals_list)
+
+    def _get_archived_ipf_ids(self, model, ipf_ids):
+        """Returns the set of IPF ids that have already been moved to the archive.
+        :param model: the name of the archive model.
+        :param ipf_ids: the IPF ids to look for.
+        """
+        ipf_ids = [ipf_id for ipf_id in ipf_ids if ipf_id]
+        if not ipf_ids:
+            return set()
+        return set(self.env[model].search([('ipf_id', 'in', ipf_ids)]).mapped('ipf_id'))
+
+    def _write_changed_vals(self, model, changes):
+        """Writes the values that have changed, with one write per distinct
+        set of changed values.
+        :param model: the name of the model of the records.
+        :param changes: a list of (record, vals) tuples.
+        :returns: the records that were written.
+        """
+        groups = {}
+        for record, vals in changes:
+            changed = self._get_changed_vals(record, vals)
+            if changed:
+                key = repr(sorted(changed.items()))
+                if key in groups:
+                    groups[key][0] |= record
+                else:
+                    groups[key] = [record, changed]
+        res = self.env[model]
+        for records, changed in groups.values():
+            records.write(changed)
+            res |= records
+        return res
+
+    def _get_changed_vals(self, record, vals):
+        """Returns the values of stored fields in vals that differ from record.
+        Many2many values are expected as a single (6, 0, ids) command."""
+        changed = {}
+        for name, value in vals.items():
+            field = record._fields.get(name)
+            if not field or not field.store or field.related:
+                continue
+            if field.type == 'many2many':
+                if set(record[name].ids) != set(value[0][2]):
+                    changed[name] = value
+            elif field.type == 'many2one':
+                if record[name].id != value:
+                    changed[name] = value
+            elif record[name] != value:
+                changed[name] = value
+        return changed
+
     # /resource-planning/competencies/schedules
     def get_schedules(self, from_datetime, to_datetime, type_ids):
         """fetches schedules from Teleopti via IPF and creates calendar.schedule in odoo"""
-        client_id = self.env['ir.config_parameter'].sudo().get_param('af_rest.client_id')
-        client_secret = self.env['ir.config_parameter'].sudo().get_param('af_rest.client_secret')
-        af_environment = self.env['ir.config_parameter'].sudo().get_param('af_rest.af_environment')
-        af_port = self.env['ir.config_parameter'].sudo().get_param('af_rest.ipf_port')
-        af_url = self.env['ir.config_parameter'].sudo().get_param('af_rest.ipf_url')
-        af_system_id = self.env['ir.config_parameter'].sudo().get_param('af_rest.af_system_id')
-
-        if not (af_url or af_port or client_id or client_secret or af_environment or af_system_id):
+        config = self.env['af.ipf.client']._get_ipf_config()
+
+        if not (config.url or config.port or config.client_id or config.client_secret or config.environment or config.system_id):
             raise Warning('Please setup AF integrations')
 
         res = self.env['calendar.schedule']
@@ -269,7 +328,7 @@ class AfAppointment(models.Model):
             type_str += "&competence_id=" + type_id.ipf_id
 
         # Generate a tracking-id
-        af_tracking_id = self._generate_tracking_id(af_system_id, af_environment)
+        af_tracking_id = self._generate_tracking_id(config.system_id, config.environment)
 
         # Define base url
         # ex: https://ipfapi.arbetsformedlingen.se:443/appointments/v1/resource-planning/competencies/schedules?from_date=2020-03-17T00:00:00Z&client_id=XXXXXXXXX&client_secret=XXXXXXXXX&to_date=2020-03-25T00:00:00Z&competence_id=ded72445-e5d3-4e21-a356-aad200dac83d
@@ -277,69 +336,92 @@ class AfAppointment(models.Model):
 
         # Insert values into base_url
         get_url = base_url.format(
-            url = af_url, # https://ipfapi.arbetsformedlingen.se
-            port = af_port, # 443
+            url = config.url, # https://ipfapi.arbetsformedlingen.se
+            port = config.port, # 443
             path = "appointments/v1/resource-planning/competencies/schedules", # TODO: remove hardcoding?
-            client = client_id, # check in anypoint for example
-            secret = client_secret, # check in anypoint for example
+            client = config.client_id, # check in anypoint for example
+            secret = config.client_secret, # check in anypoint for example
             from_date = from_datetime.strftime("%Y-%m-%dT%H:%M:%SZ"), # 2020-03-17T00:00:00Z
             to_date = to_datetime.strftime("%Y-%m-%dT%H:%M:%SZ"), # 2020-03-25T00:00:00Z
             comps = type_str, # &competence_id=ded72445-e5d3-4e21-a356-aad200dac83d
         )
 
         # Generate headers for our get
-        get_headers = self._generate_headers(af_environment, af_system_id, af_tracking_id)
+        get_headers = self._generate_headers(config.environment, config.system_id, af_tracking_id)
 
-        # Build our request using url and headers
-        # Request(url, data=None, headers={}, origin_req_host=None, unverifiable=False, method=None)
-        req = request.Request(url=get_url, headers=get_headers)
-
-        ctx = ctx = self._generate_ctx(is_remote=True) # TODO: change to False
-
-        # send GET and read result
-        req_res_json = request.urlopen(req, context=ctx).read()
-        # Convert json to python format: https://docs.python.org/3/library/json.html#json-to-py-table 
-        req_res = json.loads(req_res_json)
+        # send GET over a pooled connection and read result
+        req_res = self.env['af.ipf.client'].ipf_get(get_url, get_headers, is_remote=True) # TODO: change to False
 
         # Create calendar.schedule from req_res
         # req_res: list of dicts with list of schedules
         # schedules: list of dicts of schedules
-        for comp_day in req_res:
+        return self._upsert_schedules(req_res)
+
+    def _upsert_schedules(self, comp_days):
+        """Creates or updates calendar.schedule from the competence days of
+        a Teleopti schedule response. Competences and existing schedules are
+        resolved with one search each, new schedules are created with one
+        multi-create and changed ones are written per distinct agent count.
+        :returns: the created and updated schedules.
+        """
+        # Convert all times to UTC in one pass
+        # Integration gives us times in local (Europe/Stockholm) tz
+        offsets = {}
+        rows = []
+        for comp_day in comp_days:
             # assumes that there's only ever one competence
-            type_name = comp_day.get('competence').get('name')
-            type_id = self.env['calendar.appointment.type'].search([('ipf_id','=',comp_day.get('competence').get('id'))])
+            competence = comp_day.get('competence')
             for schedule in comp_day.get('schedules'):
-                start_time = datetime.strptime(schedule.get('start_time'), "%Y-%m-%dT%H:%M:%SZ")
-                stop_time = datetime.strptime(schedule.get('end_time'), "%Y-%m-%dT%H:%M:%SZ")
-
-                # Integration gives us times in local (Europe/Stockholm) tz
-                # Convert to UTC
-                start_time_utc = pytz.timezone(LOCAL_TZ).localize(start_time).astimezone(pytz.utc)
-                stop_time_utc = pytz.timezone(LOCAL_TZ).localize(stop_time).astimezone(pytz.utc)
-
-                # schedules can exist every half hour from 09:00 to 16:00
-                # check if calendar.schedule already exists 
-                schedule_id = self.env['calendar.schedule'].search([('type_id','=',type_id.id), ('start','=',start_time_utc)])
-                if schedule_id:
-                    # Update existing schedule only two values can change 
-                    vals = {
-                        'scheduled_agents': schedule.get('scheduled_agents'), # number of agents supposed to be available for this
-                        'forecasted_agents': schedule.get('forecasted_agents'), # May be implemented at a later date.
-                    }
-                    schedule_id.update(vals)
-                    res |= schedule_id
-                else:
-                    # create new schedule
-                    vals = {
-                        'name': type_name,
-                        'start': start_time_utc,
-                        'stop': stop_time_utc,
-                        'duration': 30.0,
-                        'scheduled_agents': int(schedule.get('scheduled_agents')), # number of agents supposed to be available for this. Can sometimes be float.
-                        'forecasted_agents': int(schedule.get('forecasted_agents')), # May be implemented at a later date. Can sometimes be float.
-                        'type_id': type_id.id,
-                        'channel': type_id.channel.id,
-                    }
-                    res |= self.env['calendar.schedule'].create(vals)
+                rows.append((
+                    competence,
+                    _local_to_utc(datetime.strptime(schedule.get('start_time'), "%Y-%m-%dT%H:%M:%SZ"), offsets),
+                    _local_to_utc(datetime.strptime(schedule.get('end_time'), "%Y-%m-%dT%H:%M:%SZ"), offsets),
+                    int(schedule.get('scheduled_agents')), # number of agents supposed to be available for this. Can sometimes be float.
+                    int(schedule.get('forecasted_agents')), # May be implemented at a later date. Can sometimes be float.
+                ))
+        res = self.env['calendar.schedule']
+        if not rows:
+            return res
+
+        type_ids = {type_id.ipf_id: type_id for type_id in self.env['calendar.appointment.type'].search(
+            [('ipf_id', 'in', list({row[0].get('id') for row in rows}))])}
+
+        # schedules can exist every half hour from 09:00 to 16:00
+        # fetch every calendar.schedule of the window at once
+        schedules = {(schedule.type_id.id, schedule.start): schedule for schedule in self.env['calendar.schedule'].search([
+            ('type_id', 'in', [type_id.id for type_id in type_ids.values()]),
+            ('start', '>=', min(row[1] for row in rows)),
+            ('start', '<=', max(row[1] for row in rows)),
+        ])}
+
+        vals_list = []
+        updates = {}
+        for competence, start_time_utc, stop_time_utc, scheduled_agents, forecasted_agents in rows:
+            type_id = type_ids.get(competence.get('id'), self.env['calendar.appointment.type'])
+            schedule_id = schedules.get((type_id.id, start_time_utc))
+            if schedule_id:
+                # Update existing schedule only two values can change
+                if (schedule_id.scheduled_agents, schedule_id.forecasted_agents) != (scheduled_agents, forecasted_agents):
+                    key = (scheduled_agents, forecasted_agents)
+                    updates[key] = updates.get(key, self.env['calendar.schedule']) | schedule_id
+                res |= schedule_id
+            else:
+                # create new schedule
+                vals_list.append({
+                    'name': competence.get('name'),
+                    'start': start_time_utc,
+                    'stop': stop_time_utc,
+                    'duration': 30.0,
+                    'scheduled_agents': scheduled_agents,
+                    'forecasted_agents': forecasted_agents,
+                    'type_id': type_id.id,
+                    'channel': type_id.channel.id,
+                })
+        for (scheduled_agents, forecasted_agents), schedule_ids in updates.items():
+            schedule_ids.write({
+                'scheduled_agents': scheduled_agents,
+                'forecasted_agents': forecasted_agents,
+            })
+        res |= self.env['calendar.schedule'].create(vals_list)
 
         return res
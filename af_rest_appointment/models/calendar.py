@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    Odoo, Open Source Management Solution, third party addon
+#    Copyright (C) 2004-2015 Vertel AB (<http://vertel.se>).
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+from odoo import models, fields, api, _
+import logging
+
+_logger = logging.getLogger(__name__)
+
+class CalendarOccasion(models.Model):
+    _inherit = 'calendar.occasion'
+
+    ipf_id = fields.Char(string='IPF Id', readonly=True, copy=False, help="Id of the bookable occasion in IPF")
+
+    _sql_constraints = [
+        ('ipf_id_uniq', 'unique(ipf_id)', 'An IPF occasion can only be imported once.'),
+    ]
+
+class CalendarAppointment(models.Model):
+    _inherit = 'calendar.appointment'
+
+    ipf_id = fields.Char(string='IPF Id', readonly=True, copy=False, help="Id of the appointment in IPF")
+
+    _sql_constraints = [
+        ('ipf_id_uniq', 'unique(ipf_id)', 'An IPF appointment can only be imported once.'),
+    ]
+
+class CalendarOccasionArchive(models.Model):
+    _inherit = 'calendar.occasion.archive'
+
+    ipf_id = fields.Char(string='IPF Id', readonly=True, index=True, help="Id of the bookable occasion in IPF")
+
+class CalendarAppointmentArchive(models.Model):
+    _inherit = 'calendar.appointment.archive'
+
+    ipf_id = fields.Char(string='IPF Id', readonly=True, index=True, help="Id of the appointment in IPF")
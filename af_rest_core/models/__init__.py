@@ -1,3 +1,4 @@
 # License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
 
-from . import res_config_settings
\ No newline at end of file
+from . import res_config_settings
+from . import af_ipf_client
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    Odoo, Open Source Management Solution, third party addon
+#    Copyright (C) 2004-2015 Vertel AB (<http://vertel.se>).
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+from odoo import models, api, tools, _
+from collections import namedtuple
+from http import client
+from urllib.error import HTTPError
+from urllib.parse import urlsplit
+import json
+import os
+import queue
+import ssl
+import threading
+import logging
+
+_logger = logging.getLogger(__name__)
+
+# IPF_POOL_SIZE: Number of idle keep-alive connections kept per IPF host in each worker.
+IPF_POOL_SIZE = 4
+# IPF_TIMEOUT: Default seconds to wait for IPF, used when af_rest.ipf_timeout is not a positive number.
+IPF_TIMEOUT = 30.0
+
+# IpfConfig: The IPF settings, see _get_ipf_config
+IpfConfig = namedtuple('IpfConfig', ['url', 'port', 'client_id', 'client_secret', 'environment', 'system_id', 'timeout'])
+
+_ssl_contexts = {}
+_pools = {}
+_pools_lock = threading.Lock()
+
+class AfIpfClient(models.AbstractModel):
+    _name = 'af.ipf.client'
+    _description = "IPF client"
+
+    @api.model
+    @tools.ormcache()
+    def _get_ipf_config(self):
+        """Returns the IPF settings as an IpfConfig. The environment variables
+        AFENVIRONMENT, AFIPFPORT and AFIPFURL take precedence over the system
+        parameters. Cached until the settings are saved."""
+        get_param = self.env['ir.config_parameter'].sudo().get_param
+        # A timeout of 0 would make the sockets non-blocking
+        timeout = float(get_param('af_rest.ipf_timeout') or 0)
+        return IpfConfig(
+            url=os.environ.get('AFIPFURL') or get_param('af_rest.ipf_url'),
+            port=os.environ.get('AFIPFPORT') or get_param('af_rest.ipf_port'),
+            client_id=get_param('af_rest.client_id'),
+            client_secret=get_param('af_rest.client_secret'),
+            environment=os.environ.get('AFENVIRONMENT') or get_param('af_rest.af_environment'),
+            system_id=get_param('af_rest.af_system_id'),
+            timeout=timeout if timeout > 0 else IPF_TIMEOUT,
+        )
+
+    @api.model
+    def _get_ssl_context(self, is_remote):
+        """Returns the SSL context used for IPF connections, created once per worker"""
+        ctx = _ssl_contexts.get(is_remote)
+        if ctx is None:
+            ctx = ssl.create_default_context()
+            if is_remote:
+                ctx.check_hostname = False
+                ctx.verify_mode = ssl.CERT_NONE
+            else:
+                pass # TODO: implement mTSL here?
+            ctx = _ssl_contexts.setdefault(is_remote, ctx)
+        return ctx
+
+    @api.model
+    def _get_pool(self, host, port, is_remote):
+        """Returns the pool of idle connections to an IPF host"""
+        key = (host, port, is_remote)
+        pool = _pools.get(key)
+        if pool is None:
+            with _pools_lock:
+                pool = _pools.setdefault(key, queue.LifoQueue(IPF_POOL_SIZE))
+        return pool
+
+    @api.model
+    def ipf_get(self, url, headers, is_remote=True):
+        """Sends a GET request to IPF over a pooled keep-alive connection.
+        :param url: Full url, including port and query string.
+        :param headers: Request headers.
+        :param is_remote: Skip certificate verification.
+        :returns: the decoded JSON response.
+        """
+        parts = urlsplit(url)
+        port = parts.port or 443
+        path = parts.path + ('?%s' % parts.query if parts.query else '')
+        timeout = self._get_ipf_config().timeout
+        pool = self._get_pool(parts.hostname, port, is_remote)
+        try:
+            conn = pool.get_nowait()
+            reused = True
+        except queue.Empty:
+            conn = client.HTTPSConnection(parts.hostname, port, timeout=timeout, context=self._get_ssl_context(is_remote))
+            reused = False
+        try:
+            response = self._send(conn, path, headers, timeout)
+        except (client.HTTPException, ConnectionError):
+            conn.close()
+            if not reused:
+                raise
+            # The server has closed the idle connection, retry on a new one
+            _logger.debug("IPF connection to %s:%s was closed, reconnecting" % (parts.hostname, port))
+            conn = client.HTTPSConnection(parts.hostname, port, timeout=timeout, context=self._get_ssl_context(is_remote))
+            try:
+                response = self._send(conn, path, headers, timeout)
+            except Exception:
+                conn.close()
+                raise
+        except Exception:
+            # Timeouts and other errors leave the connection in an unknown state
+            conn.close()
+            raise
+        try:
+            body = response.read()
+        except Exception:
+            conn.close()
+            raise
+        if response.will_close:
+            conn.close()
+        else:
+            try:
+                pool.put_nowait(conn)
+            except queue.Full:
+                conn.close()
+        if response.status >= 400:
+            raise HTTPError(url, response.status, response.reason, response.headers, None)
+        return json.loads(body)
+
+    @api.model
+    def _send(self, conn, path, headers, timeout):
+        conn.timeout = timeout
+        if conn.sock:
+            conn.sock.settimeout(timeout)
+        conn.request('GET', path, headers=headers)
+        return conn.getresponse()
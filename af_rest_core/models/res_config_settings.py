@@ -1,7 +1,6 @@
 # -*- coding: utf-8 -*-
 
 from odoo import api, fields, models
-import os
 
 class ResConfigSettings(models.TransientModel):
     _inherit = 'res.config.settings'
@@ -9,6 +8,7 @@ class ResConfigSettings(models.TransientModel):
     # address
     af_ipf_url = fields.Char(string='IPF API URL',help="If you need help you shouldn't be changing this")
     af_ipf_port = fields.Char(string='IPF API port',help="If you need help you shouldn't be changing this")
+    af_ipf_timeout = fields.Integer(string='IPF API timeout',help="Seconds to wait for IPF to connect or respond")
     # id and secret
     af_client_id = fields.Char(string='Client Id',help="If you need help you shouldn't be changing this")
     af_client_secret = fields.Char(string='Client secret',help="If you need help you shouldn't be changing this")
@@ -29,19 +29,17 @@ class ResConfigSettings(models.TransientModel):
     def get_values(self):
         res = super().get_values()
 
-        af_env = os.environ.get('AFENVIRONMENT')
-        af_ipfport = os.environ.get('AFIPFPORT')
-        af_ipfurl = os.environ.get('AFIPFURL')
+        # Environment variables take precedence, see af.ipf.client
+        config = self.env['af.ipf.client']._get_ipf_config()
 
-        get_param = self.env['ir.config_parameter'].sudo().get_param
-        
         res.update({
-            'af_client_id': get_param('af_rest.client_id'),
-            'af_client_secret': get_param('af_rest.client_secret'),
-            'af_environment': af_env if af_env else get_param('af_rest.af_environment') ,
-            'af_ipf_port': af_ipfport if af_ipfport else get_param('af_rest.ipf_port') ,
-            'af_ipf_url': af_ipfurl if af_ipfurl else get_param('af_rest.ipf_url') ,
-            'af_system_id': get_param('af_rest.af_system_id'),
+            'af_client_id': config.client_id,
+            'af_client_secret': config.client_secret,
+            'af_environment': config.environment,
+            'af_ipf_port': config.port,
+            'af_ipf_url': config.url,
+            'af_system_id': config.system_id,
+            'af_ipf_timeout': int(config.timeout),
             # 'af_tracking_id': get_param('af_rest.af_tracking_id'),
         })
         return res
@@ -56,6 +54,8 @@ class ResConfigSettings(models.TransientModel):
         set_param('af_rest.ipf_port', self.af_ipf_port)
         set_param('af_rest.ipf_url', self.af_ipf_url)
         set_param('af_rest.af_system_id', self.af_system_id)
+        set_param('af_rest.ipf_timeout', self.af_ipf_timeout)
+        self.env['af.ipf.client'].clear_caches()
 
 
 
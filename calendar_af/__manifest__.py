@@ -2,7 +2,7 @@
 
 {
     "name": "Calendar AF",
-    "version": "12.0.1.0.1",
+    "version": "12.0.1.0.2",
     "author": "Vertel AB",
     "license": "AGPL-3",
     "website": "https://vertel.se/",
@@ -20,12 +20,21 @@
         "views/calendar_schedule_view.xml",
         "views/calendar_appointment_view.xml",
         "views/calendar_occasion_view.xml",
+        "views/calendar_occasion_capacity_view.xml",
+        "views/calendar_occasion_daily_view.xml",
+        "views/calendar_schedule_report_view.xml",
+        "views/calendar_archive_view.xml",
         "views/calendar_channel_view.xml",
         "views/calendar_appointment_type_view.xml",
         "views/calendar_mapped_dates_view.xml",
+        "views/assets.xml",
         "security/ir.model.access.csv",
         "data/calendar.channel.csv",
         "data/calendar.appointment.type.csv",
+        "data/ir_cron.xml",
+    ],
+    "qweb": [
+        "static/src/xml/appointment_suggestions.xml",
     ],
     "application": True,
     "installable": True,
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    Odoo, Open Source Management Solution, third party addon
+#    Copyright (C) 2004-2015 Vertel AB (<http://vertel.se>).
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+from odoo.addons.calendar_af.models.calendar import BASE_DURATION
+import logging
+
+_logger = logging.getLogger(__name__)
+
+# BATCH_SIZE: Number of ids updated per statement
+BATCH_SIZE = 10000
+
+def migrate(cr, version):
+    """Backfills the slot index of existing schedules and occasions"""
+    if not version:
+        return
+    for table in ('calendar_schedule', 'calendar_occasion'):
+        cr.execute("SELECT min(id), max(id) FROM {table}".format(table=table))
+        min_id, max_id = cr.fetchone()
+        if min_id is None:
+            continue
+        updated = 0
+        for batch_start in range(min_id, max_id + 1, BATCH_SIZE):
+            cr.execute("""
+                UPDATE {table} SET slot = floor(extract(epoch FROM start) / 60 / %s)::integer
+                WHERE id >= %s AND id < %s AND slot IS NULL AND start IS NOT NULL""".format(table=table),
+                (BASE_DURATION, batch_start, batch_start + BATCH_SIZE))
+            updated += cr.rowcount
+        _logger.info("Backfilled slot index of %s rows in %s" % (updated, table))
@@ -3,3 +3,7 @@
 from . import calendar
 from . import res_partner
 from . import res_users
+from . import calendar_occasion_capacity
+from . import calendar_occasion_daily
+from . import calendar_archive
+from . import calendar_schedule_report
@@ -19,11 +19,18 @@
 #
 ##############################################################################
 
-from odoo import models, fields, api, _
+from odoo import models, fields, api, tools, _
 from datetime import datetime, timedelta, date
 from odoo.exceptions import Warning
+from odoo.osv import expression
+from odoo.tools import split_every
+from odoo.tools.lru import LRU
+from odoo.tools.sql import create_index, index_exists
+from array import array
+from collections import deque
+import bisect
 import pytz
-import copy
+import time
 import logging
 
 _logger = logging.getLogger(__name__)
@@ -38,6 +45,69 @@ BASE_DAY_START = pytz.timezone(LOCAL_TZ).localize(datetime.now().replace(hour=9,
 BASE_DAY_STOP = pytz.timezone(LOCAL_TZ).localize(datetime.now().replace(hour=16, minute=0, second=0, microsecond=0)).astimezone(pytz.utc)
 # RESERVED_TIMEOUT is the default time before a reservation times out.
 RESERVED_TIMEOUT = 300.0
+# SLOT_EPOCH: Naive UTC time where time slot 0 starts, see _get_slot.
+SLOT_EPOCH = datetime(1970, 1, 1)
+# AVAILABILITY_CACHE_SIZE: Number of get_bookable_occasions results cached per database in each worker.
+AVAILABILITY_CACHE_SIZE = 256
+
+_availability_cache = {}
+
+def _get_availability_cache(dbname):
+    cache = _availability_cache.get(dbname)
+    if cache is None:
+        cache = _availability_cache[dbname] = LRU(AVAILABILITY_CACHE_SIZE)
+    return cache
+
+def _get_day_bounds(day):
+    """Returns the first and last bookable time (naive UTC) of a date,
+    based on BASE_DAY_START and BASE_DAY_STOP in local time."""
+    local_tz = pytz.timezone(LOCAL_TZ)
+    day_start = local_tz.localize(datetime.combine(day, BASE_DAY_START.astimezone(local_tz).time()))
+    day_stop = local_tz.localize(datetime.combine(day, BASE_DAY_STOP.astimezone(local_tz).time()))
+    return day_start.astimezone(pytz.utc).replace(tzinfo=None), day_stop.astimezone(pytz.utc).replace(tzinfo=None)
+
+def _get_slot(dt, round_up=False):
+    """Returns the slot index of a naive UTC datetime, the number of
+    BASE_DURATION minutes since SLOT_EPOCH. Times within a slot are
+    rounded down, or up to the next slot if round_up is set."""
+    td_base_duration = timedelta(minutes=BASE_DURATION)
+    if round_up:
+        return -((SLOT_EPOCH - dt) // td_base_duration)
+    return (dt - SLOT_EPOCH) // td_base_duration
+
+def _get_slot_start(slot):
+    """Returns the start (naive UTC) of a slot index"""
+    return SLOT_EPOCH + timedelta(minutes=BASE_DURATION) * slot
+
+def _set_slot(vals):
+    """Adds the slot index matching the start in vals"""
+    if vals.get('start'):
+        vals['slot'] = _get_slot(fields.Datetime.to_datetime(vals['start']))
+    return vals
+
+def _find_slot_runs(capacity, no_slots, min_depth=1):
+    """Finds every position in a free capacity array where a number of
+    consecutive slots all have free occasions left.
+    :param capacity: Array with the number of free occasions per slot.
+    :param no_slots: Number of consecutive slots needed.
+    :param min_depth: Least number of free occasions needed in each slot.
+    :returns: a list of (first slot index, available depth) tuples.
+    """
+    res = []
+    if no_slots < 1:
+        return res
+    # Sliding window minimum, window[0] is the index of the smallest capacity
+    window = deque()
+    for i, depth in enumerate(capacity):
+        while window and capacity[window[-1]] >= depth:
+            window.pop()
+        window.append(i)
+        first = i - no_slots + 1
+        if window[0] < first:
+            window.popleft()
+        if first >= 0 and capacity[window[0]] >= min_depth:
+            res.append((first, capacity[window[0]]))
+    return res
 
 # Termer
 # occasions = bokningsbara tider
@@ -49,6 +119,7 @@ class CalendarSchedule(models.Model):
 
     name = fields.Char(string='Name', required=True)
     start = fields.Datetime(string='Start', required=True, help="Start date of a schedule")
+    slot = fields.Integer(string='Slot', readonly=True, help="Slot index of the start date, see _get_slot")
     stop = fields.Datetime(string='Stop', required=True, help="Stop date of a schedule")
     duration = fields.Float('Duration')
     scheduled_agents = fields.Integer(string='Scheduled agents', help="Number of scheduled agents")
@@ -56,12 +127,100 @@ class CalendarSchedule(models.Model):
     type_id = fields.Many2one(string='Meeting type', comodel_name='calendar.appointment.type', help="Related meeting type")
     channel = fields.Many2one(string='Channel', comodel_name='calendar.channel')
 
+    @api.model_cr
+    def init(self):
+        create_index(self.env.cr, 'calendar_schedule_type_id_start_index', self._table, ['type_id', 'start'])
+        create_index(self.env.cr, 'calendar_schedule_type_id_slot_index', self._table, ['type_id', 'slot'])
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        return super(CalendarSchedule, self).create([_set_slot(dict(vals)) for vals in vals_list])
+
+    @api.multi
+    def write(self, vals):
+        return super(CalendarSchedule, self).write(_set_slot(dict(vals)))
+
+    @api.multi
+    def _get_occasion_counts(self):
+        """Counts the regular (not additional) occasions in the time slots
+        of these schedules with a single grouped query.
+        :returns: a dict mapping (type_id, slot) to number of occasions.
+        """
+        if not self:
+            return {}
+        self.env.cr.execute("""
+            SELECT type_id, slot, count(id) FROM calendar_occasion
+            WHERE (type_id, slot) IN (SELECT type_id, slot FROM calendar_schedule WHERE id IN %s)
+                AND additional_booking IS NOT TRUE
+            GROUP BY type_id, slot""", (tuple(self.ids),))
+        return {(type_id, slot): count for type_id, slot, count in self.env.cr.fetchall()}
+
+    @api.multi
+    def reconcile_occasions(self):
+        """Removes free occasions exceeding the number of scheduled agents of
+        these schedules. Booked occasions are never removed.
+        :returns: a list of conflicts, one dict per schedule that has more
+        booked occasions than scheduled agents.
+        """
+        if not self:
+            return []
+        # Number the occasions of each slot, booked ones first. Free
+        # occasions numbered above the scheduled agents are surplus.
+        self.env.cr.execute("""
+            WITH schedule AS (
+                SELECT type_id, slot, max(scheduled_agents) AS scheduled_agents
+                FROM calendar_schedule WHERE id IN %s
+                GROUP BY type_id, slot
+            ), occasion AS (
+                SELECT o.id, o.appointment_id, s.scheduled_agents,
+                    row_number() OVER (PARTITION BY o.type_id, o.slot ORDER BY o.appointment_id IS NULL, o.id) AS number
+                FROM calendar_occasion o
+                JOIN schedule s ON s.type_id = o.type_id AND s.slot = o.slot
+                WHERE o.additional_booking IS NOT TRUE
+            )
+            SELECT id FROM occasion WHERE appointment_id IS NULL AND number > scheduled_agents""",
+            (tuple(self.ids),))
+        surplus_ids = [row[0] for row in self.env.cr.fetchall()]
+        self.env['calendar.occasion'].browse(surplus_ids).unlink()
+
+        self.env.cr.execute("""
+            SELECT s.id, s.scheduled_agents, count(o.id)
+            FROM calendar_schedule s
+            JOIN calendar_occasion o ON o.type_id = s.type_id AND o.slot = s.slot
+            WHERE s.id IN %s AND o.appointment_id IS NOT NULL AND o.additional_booking IS NOT TRUE
+            GROUP BY s.id, s.scheduled_agents
+            HAVING count(o.id) > s.scheduled_agents""", (tuple(self.ids),))
+        conflicts = [{
+            'schedule_id': schedule_id,
+            'scheduled_agents': scheduled_agents,
+            'booked_occasions': booked_occasions,
+        } for schedule_id, scheduled_agents, booked_occasions in self.env.cr.fetchall()]
+        if surplus_ids:
+            _logger.info("Removed %s surplus occasions" % len(surplus_ids))
+        for conflict in conflicts:
+            _logger.warning("Schedule %(schedule_id)s has %(booked_occasions)s booked occasions but only %(scheduled_agents)s scheduled agents" % conflict)
+        return conflicts
+
     @api.multi
     def create_occasions(self):
-        """Creates a number of occasions from schedules, depending on number of scheduled agents"""
+        """Creates a number of occasions from schedules, depending on number of scheduled agents.
+        With the 'counter' occasion storage the free occasions are kept as a count per time slot.
+        Surplus free occasions are removed when the number of scheduled agents has decreased.
+        :returns: a list of conflicts, see reconcile_occasions.
+        """
+        counter_storage = self.env['calendar.occasion']._get_occasion_storage() == 'counter'
+        occasion_counts = self._get_occasion_counts()
+        counters = {}
+        vals_list = []
+        surplus = self.env['calendar.schedule']
         for schedule in self:
-            no_occasions = self.env['calendar.occasion'].search_count([('start', '=', schedule.start), ('type_id', '=', schedule.type_id.id), ('additional_booking', '=', False)])
-            if (schedule.scheduled_agents - no_occasions) > 0:
+            key = (schedule.type_id.id, schedule.slot)
+            no_occasions = occasion_counts.get(key, 0)
+            if (schedule.scheduled_agents - no_occasions) < 0:
+                surplus |= schedule
+            if counter_storage:
+                counters[(schedule.type_id.id, schedule.start)] = max(schedule.scheduled_agents - no_occasions, 0)
+            elif (schedule.scheduled_agents - no_occasions) > 0:
                 vals = {
                     'name': '%sm @ %s' % (schedule.duration, schedule.start.strftime("%Y-%m-%dT%H:%M:%S")),
                     'duration': schedule.duration,
@@ -73,11 +232,12 @@ class CalendarSchedule(models.Model):
                     'state': 'ok',
                 }
                 for occasion in range(schedule.scheduled_agents - no_occasions):
-                    self.env['calendar.occasion'].create(vals)
-
-            elif (schedule.scheduled_agents - no_occasions) < 0:
-                # TODO: handle this case better
-                pass
+                    vals_list.append(dict(vals))
+                # Later schedules for the same slot see these occasions
+                occasion_counts[key] = schedule.scheduled_agents
+        self.env['calendar.occasion'].create(vals_list)
+        self.env['calendar.occasion.capacity']._set_counters(counters)
+        return surplus.reconcile_occasions()
 
 class CalendarAppointmentType(models.Model):
     _name = 'calendar.appointment.type'
@@ -108,44 +268,58 @@ class CalendarMappedDates(models.Model):
     name = fields.Char(string="Name")
     from_date = fields.Date(string='From Date', required=True)
     to_date = fields.Date(string='To Date', required=True)
+    map_range = fields.Boolean(string='Map Range', help="Map every date from From Date up to To Date, not only From Date")
 
-class CalendarAppointmentSuggestion(models.Model):
-    _name = 'calendar.appointment.suggestion'
-    _description = "Bookable Occasion"
+    @api.model_create_multi
+    def create(self, vals_list):
+        res = super(CalendarMappedDates, self).create(vals_list)
+        self.clear_caches()
+        return res
 
-    appointment_id = fields.Many2one(comodel_name='calendar.appointment', ondelete='cascade')
-    start = fields.Datetime()
-    stop = fields.Datetime()
-    occasion_ids = fields.Many2many(comodel_name='calendar.occasion', string="Occasions")
+    @api.multi
+    def write(self, vals):
+        res = super(CalendarMappedDates, self).write(vals)
+        self.clear_caches()
+        return res
 
     @api.multi
-    def select_suggestion(self):
-        # Kontrollera att occasion_ids fortfarande är lediga
-        # Skriv data till appointment_id
-        if self.appointment_id.state == 'reserved':
-            raise Warning("This appointment is already booked.")
-        occasions = self.env['calendar.occasion']
-        for occasion in self.occasion_ids:
-            # Ensure that occasions are still free
-            if not occasion.appointment_id:
-                occasions |= occasion
+    def unlink(self):
+        res = super(CalendarMappedDates, self).unlink()
+        self.clear_caches()
+        return res
+
+    @api.model
+    @tools.ormcache()
+    def _get_mapping_index(self):
+        """Returns all date mappings sorted on From Date, as a tuple of
+        From Dates, the last date reached by any range up to each position
+        and (from date, last date, mapped date) ranges. Loaded once per
+        registry and cleared when a mapping changes."""
+        ranges = []
+        for mapping in self.sudo().search([], order='from_date, id'):
+            if mapping.map_range and mapping.to_date > mapping.from_date:
+                last_date = mapping.to_date - timedelta(days=1)
             else:
-                free_occasion = occasion.search(
-                    [
-                        ('start', '=', self.start),
-                        ('type_id', '=', self.type_id.id),
-                        #('channel', '=', self.channel.id),
-                        ('appointment_id', '=', False)
-                    ], limit=1)
-                if not free_occasion:
-                    raise Warning(_("You are screwed."))
-                occasions |= free_occasion
-        occasions.write({'appointment_id': self.appointment_id.id})
-        self.appointment_id.write({
-            'state': 'reserved',
-            'start': self.start,
-            'stop': self.stop,
-        })
+                last_date = mapping.from_date
+            ranges.append((mapping.from_date, last_date, mapping.to_date))
+        reach = []
+        for from_date, last_date, to_date in ranges:
+            reach.append(max(reach[-1], last_date) if reach else last_date)
+        return tuple(r[0] for r in ranges), tuple(reach), tuple(ranges)
+
+    @api.model
+    def _map_date(self, date):
+        """Returns the mapped date of a date, or the date itself if it is not mapped"""
+        starts, reach, ranges = self._get_mapping_index()
+        i = bisect.bisect_right(starts, date)
+        # Walk back over the ranges starting before the date, as long as
+        # any of them still reaches it
+        while i > 0 and reach[i - 1] >= date:
+            i -= 1
+            from_date, last_date, to_date = ranges[i]
+            if date <= last_date:
+                return to_date
+        return date
 
 class CalendarAppointment(models.Model):
     _name = 'calendar.appointment'
@@ -173,31 +347,92 @@ class CalendarAppointment(models.Model):
     additional_booking = fields.Boolean(String='Over booking', related='occasion_ids.additional_booking')
     reserved = fields.Datetime(string='Reserved', help="Occasions was reserved at this date and time")
     description = fields.Text(string='Description')
-    suggestion_ids = fields.One2many(comodel_name='calendar.appointment.suggestion', inverse_name='appointment_id', string='Suggested Dates')
     """ suggestion_id = fields.Many2one(comodel_name='calendar.appointment.suggestion', string='Suggested Dates') """
 
 
-    @api.onchange('duration', 'type_id', 'channel')
-    def compute_suggestion_ids(self):
-        if self.suggestion_ids:
-            self.suggestion_ids.unlink()
-        if not all((self.duration, self.type_id, self.channel)):
-            return
+    @api.multi
+    def _get_suggestions(self, token=False):
+        """Returns a page of suggested times for this appointment. Nothing
+        is written, additional occasions of a full window are only
+        suggested and are created by select_suggestion.
+        :param token: Continuation token of the previous page.
+        :returns: a dict with a list of suggestions and the token of the
+        next page, False on the last page.
+        """
+        if self.state != 'free' or not all((self.duration, self.type_id)):
+            return {'suggestions': [], 'token': False}
         start = self.start_meeting_search()
         stop = self.stop_meeting_search(start)
-        suggestion_ids = []
-        occasions = self.env['calendar.occasion'].get_bookable_occasions(start, stop, self.duration * 60, self.type_id, max_depth = 1)
-        _logger.warn(occasions)
-        for day in occasions:
-            for day_occasions in day:
-                for occasion in day_occasions:
-                    suggestion_ids.append((0, 0, {
-                        # Fyll i occasions-data på förslagen
-                        'start': occasion[0].start,
-                        'stop': occasion[-1].stop,
-                        'occasion_ids': [(6, 0, occasion._ids)],
-                    }))
-        self.suggestion_ids = suggestion_ids
+        duration = self.duration * 60
+        limit = int(self.env['ir.config_parameter'].sudo().get_param('af_calendar.suggestion_limit', default='20'))
+        occasions, next_token = self.env['calendar.occasion'].get_first_bookable_occasions(start, stop, duration, self.type_id,
+            limit=limit, max_depth = 1, token=token, additional_booking=False)
+        suggestions = [{
+            'start': fields.Datetime.to_string(occasion[0].start),
+            'stop': fields.Datetime.to_string(occasion[-1].stop),
+            'type_id': occasion[0].type_id.id,
+            'occasion_ids': occasion.filtered('id').ids,
+            'additional_booking': False,
+        } for occasion in occasions]
+        if not suggestions and not token and self.type_id.additional_booking:
+            additional_start = self.env['calendar.occasion']._get_additional_booking_start(stop.date(), duration, self.type_id)
+            suggestions.append({
+                'start': fields.Datetime.to_string(additional_start),
+                'stop': fields.Datetime.to_string(additional_start + timedelta(minutes=int(duration / BASE_DURATION) * BASE_DURATION)),
+                'type_id': self.type_id.id,
+                'occasion_ids': [],
+                'additional_booking': True,
+            })
+        return {
+            'suggestions': suggestions,
+            'token': next_token,
+        }
+
+    @api.multi
+    def get_suggestions(self, token=False):
+        """Returns a page of suggested times, see _get_suggestions. Call again
+        with the returned token to get the next page."""
+        self.ensure_one()
+        return self._get_suggestions(token)
+
+    @api.multi
+    def select_suggestion(self, suggestion):
+        """Books a suggestion returned by get_suggestions on this appointment.
+        Additional occasions of a suggested additional booking are created here.
+        :param suggestion: a dict with start, stop, occasion_ids and additional_booking.
+        """
+        self.ensure_one()
+        # Kontrollera att occasion_ids fortfarande är lediga
+        # Skriv data till appointment_id
+        if self.state == 'reserved':
+            raise Warning("This appointment is already booked.")
+        start = fields.Datetime.to_datetime(suggestion['start'])
+        stop = fields.Datetime.to_datetime(suggestion['stop'])
+        if suggestion.get('additional_booking'):
+            if not self.type_id.additional_booking:
+                raise Warning(_("This meeting type does not allow additional bookings."))
+            suggested = self.env['calendar.occasion'].with_context(defer_capacity=True)._create_additional_occasions(start, self.duration * 60, self.type_id)
+        else:
+            suggested = self.env['calendar.occasion'].browse(suggestion.get('occasion_ids') or []).exists()
+        # Booking only queues the capacity of its time slots, see _capacity_changed
+        occasions = self.env['calendar.occasion'].with_context(defer_capacity=True)
+        for slot in range(_get_slot(start), _get_slot(stop, round_up=True)):
+            # Ensure that occasions are still free
+            preferred = suggested.filtered(lambda o: o.slot == slot)[:1]
+            occasion = occasions._claim_occasion(self.type_id, slot, preferred.id, occasions.ids)
+            if not occasion:
+                # Draw from the slot counter
+                occasion = occasions._new_counter_occasion(self.type_id, _get_slot_start(slot))._draw_occasions(self.id)
+            if not occasion:
+                raise Warning(_("You are screwed."))
+            occasions |= occasion
+        occasions.write({'appointment_id': self.id})
+        self.write({
+            'state': 'reserved',
+            'start': start,
+            'stop': stop,
+        })
+        return True
     
     @api.onchange('duration', 'start')
     def onchange_duration_start(self):
@@ -269,6 +504,54 @@ class CalendarAppointment(models.Model):
             res = super(CalendarAppointment, self).write(values)
         return res
 
+    @api.multi
+    def unlink(self):
+        # Occasions are released by the database, recount their time slots
+        keys = self.mapped('occasion_ids')._get_capacity_keys()
+        res = super(CalendarAppointment, self).unlink()
+        self.env['calendar.occasion']._capacity_changed(keys)
+        return res
+
+    @api.model
+    def _reap_expired_reservations(self, chunk_size=1000):
+        """Releases the occasions of reservations older than RESERVED_TIMEOUT
+        and deletes the reservations, one chunk at a time. Run by cron.
+        :param chunk_size: Number of reservations handled per statement.
+        :returns: a dict with the number of released reservations and
+        occasions and the time it took in seconds.
+        """
+        started = time.time()
+        expired = datetime.now() - timedelta(seconds=RESERVED_TIMEOUT)
+        self.env.cr.execute("""
+            SELECT id FROM calendar_appointment
+            WHERE state = 'reserved' AND reserved < %s
+            ORDER BY id""", (expired,))
+        reservation_ids = [row[0] for row in self.env.cr.fetchall()]
+        res = {'reservations': 0, 'occasions': 0}
+        for chunk in split_every(chunk_size, reservation_ids):
+            # Confirmed or renewed reservations are left alone
+            self.env.cr.execute("""
+                SELECT id FROM calendar_appointment
+                WHERE id IN %s AND state = 'reserved' AND reserved < %s
+                FOR UPDATE SKIP LOCKED""", (chunk, expired))
+            chunk = tuple(row[0] for row in self.env.cr.fetchall())
+            if not chunk:
+                continue
+            self.env.cr.execute("""
+                UPDATE calendar_occasion SET appointment_id = NULL, write_uid = %s, write_date = now() AT TIME ZONE 'UTC'
+                WHERE appointment_id IN %s
+                RETURNING type_id, start""", (self.env.uid, chunk))
+            keys = self.env.cr.fetchall()
+            self.env.cr.execute("DELETE FROM calendar_appointment WHERE id IN %s", (chunk,))
+            self.env['calendar.occasion.capacity']._update_capacity(keys)
+            res['reservations'] += len(chunk)
+            res['occasions'] += len(keys)
+        self.invalidate_cache()
+        self.env['calendar.occasion'].invalidate_cache()
+        res['duration'] = time.time() - started
+        _logger.info("Released %(reservations)s expired reservations with %(occasions)s occasions in %(duration).2f s" % res)
+        return res
+
     @api.model
     def delete_reservation(self, occasions):
         """Deletes a reservation
@@ -286,9 +569,10 @@ class CalendarOccasion(models.Model):
 
     name = fields.Char(string='Name', required=True)
     start = fields.Datetime(string='Start', required=True, help="Start date of an occasion")
+    slot = fields.Integer(string='Slot', readonly=True, help="Slot index of the start date, see _get_slot")
     stop = fields.Datetime(string='Stop', required=True, help="Stop date of an occasion")
     duration = fields.Float('Duration')
-    appointment_id = fields.Many2one(comodel_name='calendar.appointment', string="Appointment")
+    appointment_id = fields.Many2one(comodel_name='calendar.appointment', string="Appointment", index=True)
     type_id = fields.Many2one(comodel_name='calendar.appointment.type', string='Type')
     channel = fields.Many2one(string='Channel', comodel_name='calendar.channel', related='type_id.channel')
     additional_booking = fields.Boolean(String='Over booking')
@@ -300,6 +584,102 @@ class CalendarOccasion(models.Model):
                                         default='request', 
                                         help="Status of the meeting")
 
+    @api.model_cr
+    def init(self):
+        # Indexes for the availability, overbooking and reservation queries
+        create_index(self.env.cr, 'calendar_occasion_type_id_start_index', self._table, ['type_id', 'start'])
+        create_index(self.env.cr, 'calendar_occasion_type_id_slot_index', self._table, ['type_id', 'slot'])
+        if not index_exists(self.env.cr, 'calendar_occasion_free_slot_index'):
+            self.env.cr.execute("""
+                CREATE INDEX calendar_occasion_free_slot_index ON calendar_occasion (type_id, slot)
+                WHERE appointment_id IS NULL AND state = 'ok'""")
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        res = super(CalendarOccasion, self).create([_set_slot(dict(vals)) for vals in vals_list])
+        self._capacity_changed(res._get_capacity_keys())
+        return res
+
+    @api.multi
+    def write(self, vals):
+        vals = _set_slot(dict(vals))
+        if not any(field in vals for field in ('start', 'type_id', 'appointment_id', 'state')):
+            return super(CalendarOccasion, self).write(vals)
+        keys = self._get_capacity_keys()
+        res = super(CalendarOccasion, self).write(vals)
+        self._capacity_changed(keys | self._get_capacity_keys())
+        return res
+
+    @api.multi
+    def unlink(self):
+        keys = self._get_capacity_keys()
+        res = super(CalendarOccasion, self).unlink()
+        self._capacity_changed(keys)
+        return res
+
+    @api.model
+    def _capacity_changed(self, keys):
+        """Recounts the capacity of time slots whose occasions have changed,
+        so that released, approved and imported occasions are offered right
+        away. Bookings set the context key defer_capacity and only queue
+        their time slots: the capacity rows are shared by every booking of
+        a time slot and would serialize concurrent bookings.
+        :param keys: an iterable of (type_id, start) tuples.
+        """
+        if self.env.context.get('defer_capacity'):
+            self.env['calendar.occasion.capacity']._queue_keys(keys)
+        else:
+            self.env['calendar.occasion.capacity']._update_capacity(keys)
+
+    @api.model
+    def _get_occasion_storage(self):
+        """Returns how free occasions are stored. 'row' creates one occasion
+        per scheduled agent, 'counter' keeps a count per time slot in
+        calendar.occasion.capacity and only creates occasions when booked."""
+        return self.env['ir.config_parameter'].sudo().get_param('af_calendar.occasion_storage', default='row')
+
+    @api.model
+    def _new_counter_occasion(self, type_id, start):
+        """Returns an unsaved occasion standing in for one free occasion
+        of a time slot counter"""
+        return self.env['calendar.occasion'].new(self._get_counter_occasion_vals(type_id, start))
+
+    @api.model
+    def _get_counter_occasion_vals(self, type_id, start):
+        return {
+            'name': '%sm @ %s' % (BASE_DURATION, start.strftime("%Y-%m-%dT%H:%M:%S")),
+            'start': start,
+            'slot': _get_slot(start),
+            'stop': start + timedelta(minutes=BASE_DURATION),
+            'duration': BASE_DURATION,
+            'type_id': type_id.id,
+            'additional_booking': False,
+            'state': 'ok',
+        }
+
+    @api.multi
+    def _draw_occasions(self, appointment_id):
+        """Books unsaved counter occasions on an appointment by drawing them
+        from their time slot counters.
+        :param appointment_id: Id of the appointment to book.
+        :returns: the stored occasions, or False if a counter has run out.
+        """
+        if not self:
+            return self.env['calendar.occasion']
+        if not self.env['calendar.occasion.capacity']._draw_counters(self._get_capacity_keys()):
+            return False
+        vals_list = []
+        for occasion in self:
+            vals = self._get_counter_occasion_vals(occasion.type_id, occasion.start)
+            vals['appointment_id'] = appointment_id
+            vals_list.append(vals)
+        return self.env['calendar.occasion'].create(vals_list)
+
+    @api.multi
+    def _get_capacity_keys(self):
+        """Returns the time slots, as (type_id, start) tuples, of these occasions"""
+        return {(occasion.type_id.id, occasion.start) for occasion in self}
+
     @api.model
     def _force_create_occasion(self, duration, start, type_id, channel, state):
         """In case we need to force through a new occasion for some reason"""
@@ -318,55 +698,69 @@ class CalendarOccasion(models.Model):
         return res
 
     @api.model
-    def _get_min_occasions(self, type_id, date_start=None, date_stop=None):
+    def _get_min_occasions(self, type_id, date_start=None, date_stop=None, no_occasions=1):
         """Returns the timeslot (as a start date, DateTime) with the least 
         amount of occurances for a specific timeframe"""
-        date_start = date_start or copy.copy(BASE_DAY_START)
-        date_stop= date_stop or copy.copy(BASE_DAY_STOP)
-        go = True
-        loop_date = date_start
-        occ_time = {}
-        while go:
-            occ_time[loop_date.strftime("%Y-%m-%dT%H:%M:%S")] = self.env['calendar.occasion'].search_count([('start', '=', loop_date),('type_id', '=', type_id.id)])
-            loop_date = loop_date + timedelta(minutes=BASE_DURATION)
-            if loop_date >= date_stop:
-                go = False
-        occ_time_min_key = min(occ_time, key=occ_time.get)
-        res = datetime.strptime(occ_time_min_key, "%Y-%m-%dT%H:%M:%S")
-        return res
+        date_start = (date_start or BASE_DAY_START).replace(tzinfo=None)
+        date_stop = (date_stop or BASE_DAY_STOP).replace(tzinfo=None)
+        first_slot = _get_slot(date_start, round_up=True)
+        # Only slots where a chain of no_occasions occasions fits
+        last_slot = _get_slot(date_stop) - max(no_occasions, 1)
+        # Count the occasions themselves, the capacity rows are recounted by
+        # the queue and would not see additional occasions created since
+        self.env.cr.execute("""
+            SELECT slot, count(id) FROM calendar_occasion
+            WHERE type_id = %s AND slot >= %s AND slot <= %s
+            GROUP BY slot""",
+            (type_id.id, first_slot, last_slot))
+        totals = dict(self.env.cr.fetchall())
+        # Free occasions held in slot counters have no rows
+        self.env.cr.execute("""
+            SELECT start, counter FROM calendar_occasion_capacity
+            WHERE type_id = %s AND start >= %s AND start < %s AND counter > 0""",
+            (type_id.id, date_start, date_stop))
+        for start, counter in self.env.cr.fetchall():
+            slot = _get_slot(start)
+            totals[slot] = totals.get(slot, 0) + counter
+        res = min(((totals.get(slot, 0), slot) for slot in range(first_slot, last_slot + 1)), default=None)
+        # Fall back to the start of the timeframe if the chain does not fit
+        return _get_slot_start(res[1]) if res else date_start
 
     @api.model
     def _check_date_mapping(self, date):
         """Checks if a date has a mapped date, and returns the mapped date 
         if it exists """
-        mapped_date = self.env['calendar.mapped_dates'].search([('from_date', '=', date)])
-        if mapped_date:
-            res = mapped_date.to_date 
-        else:
-            res = date
-        return res
+        if isinstance(date, datetime):
+            date = date.date()
+        return self.env['calendar.mapped_dates']._map_date(date)
 
     @api.model
     def _get_additional_booking(self, date, duration, type_id):
         """"Creates extra, additional, occasions"""
+        start_date = self._get_additional_booking_start(date, duration, type_id)
+        return self._create_additional_occasions(start_date, duration, type_id)
+
+    @api.model
+    def _get_additional_booking_start(self, date, duration, type_id):
+        """Returns when additional occasions for a booking on a day would be
+        created, see _get_additional_booking. Creates nothing."""
         # Replace date with mapped date if we have one
         date = self._check_date_mapping(date)
-        date_list = date.strftime("%Y-%-m-%-d").split("-")
-        # Copy to make sure we dont overwrite BASE_DAY_START or BASE_DAY_STOP
-        day_start = copy.copy(BASE_DAY_START)
-        day_stop = copy.copy(BASE_DAY_STOP)
-        # Ugly, ugly code..
-        day_start.replace(year=int(date_list[0]), month=int(date_list[1]), day=int(date_list[2]))
-        day_stop.replace(year=int(date_list[0]), month=int(date_list[1]), day=int(date_list[2]))
-        # Find when to create new occasion
-        start_date = self._get_min_occasions(type_id, day_start, day_stop)
+        day_start, day_stop = _get_day_bounds(date)
         # Calculate how many occasions we need
         no_occasions = int(duration / BASE_DURATION)
+        # Find when to create new occasion
+        return self._get_min_occasions(type_id, day_start, day_stop, no_occasions)
+
+    @api.model
+    def _create_additional_occasions(self, start_date, duration, type_id):
+        """Creates the additional occasions of a booking starting at start_date"""
+        no_occasions = int(duration / BASE_DURATION)
         # Create new occasions.
-        res = self.env['calendar.occasion']
-        _logger.warn('%s %s %s' % (date, duration, no_occasions))
+        _logger.debug('%s %s %s' % (start_date, duration, no_occasions))
+        vals_list = []
         for i in range(no_occasions):
-            vals = {
+            vals_list.append({
                 'name': '%sm @ %s' % (duration, start_date),
                 'start': start_date,
                 'stop': start_date + timedelta(minutes=BASE_DURATION),
@@ -376,11 +770,9 @@ class CalendarOccasion(models.Model):
                 'channel': type_id.channel.id,
                 'additional_booking': True,
                 'state': 'ok',
-            }
-            _logger.warn(vals)
-            res |= self.env['calendar.occasion'].create(vals)
+            })
             start_date = start_date + timedelta(minutes=BASE_DURATION)
-        return res
+        return self.env['calendar.occasion'].create(vals_list)
 
     @api.multi
     def approve_occasion(self):
@@ -404,6 +796,55 @@ class CalendarOccasion(models.Model):
 
         return ret
 
+    @api.model
+    def _get_free_occasions_by_slot(self, slots, type_id, max_depth=1, free_capacity=None):
+        """Loads the free occasions of a meeting type for a number of time
+        slots with a single query and groups them per time slot. Slots with
+        a counter are filled up with unsaved counter occasions.
+        :param slots: Slot indexes of the time slots to load.
+        :param type_id: Meeting type.
+        :param max_depth: Maximum number of occasions kept per time slot.
+        :param free_capacity: Free capacity per slot, as returned by
+        calendar.occasion.capacity._get_free_capacity.
+        :returns: a dict mapping slot index to a recordset of occasions.
+        """
+        res = self._get_free_occasions_by_type_slot({(type_id.id, slot) for slot in slots}, max_depth, {type_id.id: free_capacity or {}})
+        return {slot: occasions for (type_id, slot), occasions in res.items()}
+
+    @api.model
+    def _get_free_occasions_by_type_slot(self, keys, max_depth=1, free_capacity=None):
+        """Loads the free occasions of a number of time slots of one or more
+        meeting types with a single query, see _get_free_occasions_by_slot.
+        :param keys: an iterable of (type_id, slot) tuples.
+        :param max_depth: Maximum number of occasions kept per time slot.
+        :param free_capacity: Free capacity per type and slot, as returned by
+        calendar.occasion.capacity._get_free_capacity_multi.
+        :returns: a dict mapping (type_id, slot) to a recordset of occasions.
+        """
+        keys = set(keys)
+        if not keys:
+            return {}
+        type_slots = {}
+        for type_id, slot in keys:
+            type_slots.setdefault(type_id, set()).add(slot)
+        occasions = self.env['calendar.occasion'].search(
+            expression.AND([
+                expression.OR([[('type_id', '=', type_id), ('slot', 'in', list(slots))] for type_id, slots in type_slots.items()]),
+                [('appointment_id', '=', False), ('state', '=', 'ok')],
+            ]), order='slot, id')
+        key_ids = {}
+        for occasion in occasions:
+            ids = key_ids.setdefault((occasion.type_id.id, occasion.slot), [])
+            if len(ids) < max_depth:
+                ids.append(occasion.id)
+        res = {key: occasions.browse(ids) for key, ids in key_ids.items() if key in keys}
+        for type_id, slot in keys:
+            counter = (free_capacity or {}).get(type_id, {}).get(slot, (0, 0))[1]
+            for i in range(min(counter, max_depth - len(key_ids.get((type_id, slot), [])))):
+                res[(type_id, slot)] = res.get((type_id, slot), occasions.browse()) | self._new_counter_occasion(
+                    self.env['calendar.appointment.type'].browse(type_id), _get_slot_start(slot))
+        return res
+
     @api.model
     def get_bookable_occasions(self, start, stop, duration, type_id, max_depth = 1):
         """Returns a list of occasions matching the defined parameters of the appointment. Creates additional 
@@ -414,110 +855,227 @@ class CalendarOccasion(models.Model):
         :param type_id: Meeting type.
         :param max_depth: Number of bookable occasions per time slot.
         """
-        # Calculate number of occasions needed to match booking duration
-        no_occasions = int(duration / BASE_DURATION)
-        date_delta = (stop - start)
-        td_base_duration = timedelta(minutes=BASE_DURATION)
-        
-        def get_occasions(start_dt):
-            _logger.warn(start_dt)
-            return self.env['calendar.occasion'].search(
-                [
-                    ('start', '=', start_dt),
-                    ('type_id', '=', type_id.id),
-                    #('channel', '=', channel),
-                    ('appointment_id', '=', False)
-                ], limit=max_depth)
-        #[[[], []], dag[tidsslot[ocassions]]]
-
-        occ_lists = []
-        # declare lists for each day
-        for i in range(date_delta.days + 1):
-            occ_lists.append([])
-
-        
-        # find occasions for each day, starting with last day
-        # TODO: Go backwards
-        for day in range(date_delta.days + 1):
-            occasions = []
-            # find 'max_depth' number of free occasions for each timeslot
-            if day == 0:
-                start_dt = copy.copy(start)
-                last_slot = copy.copy(start)
-                last_slot.replace(hour=BASE_DAY_STOP.hour, minute=BASE_DAY_STOP.minute)
-                if last_slot > stop:
-                    last_slot = copy.copy(stop)
-                last_slot -= timedelta(minutes=duration)
-            else:
-                # This will break given certain times and timezones. Should work for us.
-                start_dt = start_dt + timedelta(days=1)
-                start_dt.replace(hour=BASE_DAY_START.hour, minute=BASE_DAY_START.minute)
-            _logger.warn('%s - %s' % (start_dt, last_slot))
-            while start_dt <= last_slot:
-                if not occasions:
-                    for i in range(no_occasions):
-                        dt_start = start_dt + td_base_duration * i
-                        occasions.append(get_occasions(dt_start))
-                else:
-                    occasions.remove(0)
-                    occasions.append(get_occasions(start_dt + td_base_duration * no_occasions))
-                available_depth = min([len(o) for o in occasions] or [0])
-                slot = []
-                for i in range(available_depth):
-                    slot_occasion = self.env['calendar.occasion']
-                    for occ in occasions:
-                        slot_occasion |= occ[i]
-                    slot.append(slot_occasion)
-                if slot:
-                    occ_lists[day].append(slot)
-                start_dt += td_base_duration
-
-                """ 
-                iteration_start = start + timedelta(minutes=BASE_DURATION) * i
-                occasion_ids = self.env['calendar.occasion'].search(
-                    [
-                        ('start', '=', iteration_start + timedelta(days=(date_delta.days - day))),
-                        ('type_id', '=', type_id.id),
-                        ('channel', '=', channel),
-                        ('appointment_id', '=', False)
-                    ], limit=max_depth)
-                # save one result from each timeslot in a seperate list 
-                for j in range(len(occasion_ids)):
-                    occ_lists[j] += occasion_ids[j] """
+        occ_lists = self._get_cached_bookable_occasions(start, stop, duration, type_id, max_depth)
 
         # if type allows additional bookings and  we didn't find any
         # free occasions, create new ones:
         # TODO: do not create extra occasions unless completely empty?
-        if all( not l for l in occ_lists):
-            occ_lists[-1].append(self._get_additional_booking(start_dt, duration, type_id))
-        """ for day in range(date_delta.days or 1):
-            if len(occ_lists[day]) != no_occasions:
-                if type_id.additional_booking:
-                    day_start = start + timedelta(days=(date_delta.days - day))
-                    occ_lists[day] = self._get_additional_booking(day_start, duration, type_id) """
-                # TODO: else: remove partial matches, these are unusable
-                # del occ_lists[i]
-                # del will cause problems with the for loop..
+        if type_id.additional_booking and all(not l for l in occ_lists):
+            occ_lists[-1].append([self._get_additional_booking((start + timedelta(days=len(occ_lists) - 1)).date(), duration, type_id)])
+
+        return occ_lists
+
+    @api.model
+    def get_first_bookable_occasions(self, start, stop, duration, type_id, limit=10, max_depth=1, token=False, additional_booking=True):
+        """Returns the first chains of occasions matching a booking in time
+        order. The window is searched one day at a time and the search stops
+        as soon as enough chains are found. Creates additional occasions if
+        allowed and the whole window is full.
+        :param start: Start search as this time.
+        :param stop: Stop search as this time.
+        :param duration: Meeting length.
+        :param type_id: Meeting type.
+        :param limit: Number of chains wanted. Time slots are never split,
+        so up to max_depth - 1 extra chains may be returned.
+        :param max_depth: Number of bookable occasions per time slot.
+        :param token: Continuation token from a previous call, the search
+        resumes after the last time slot returned by that call.
+        :param additional_booking: Create additional occasions when the
+        window is full. Only pass True when booking, never when listing.
+        :returns: a tuple of a list of occasion chains and a continuation
+        token, False when the window has been searched to the end.
+        """
+        search_start = fields.Datetime.from_string(token) if token else start
+        chains = []
+        while search_start < stop:
+            search_stop = min(datetime.combine(search_start.date() + timedelta(days=1), datetime.min.time()), stop)
+            for day in self._get_cached_bookable_occasions(search_start, search_stop, duration, type_id, max_depth):
+                for slot in day:
+                    chains += slot
+                    if len(chains) >= limit:
+                        return chains, fields.Datetime.to_string(slot[0][0].start + timedelta(minutes=BASE_DURATION))
+            search_start = search_stop
+        if not chains and not token and additional_booking and type_id.additional_booking:
+            chains.append(self._get_additional_booking(stop.date(), duration, type_id))
+        return chains, False
 
+    @api.model
+    def _get_cached_bookable_occasions(self, start, stop, duration, type_id, max_depth=1):
+        """Returns the bookable occasions of _find_bookable_occasions from the
+        availability cache. A cached result is only used while the capacity
+        rows of its meeting type and window are unchanged, which also covers
+        bookings made by other workers."""
+        # Only whole slots within the window matter
+        start = _get_slot_start(_get_slot(start, round_up=True))
+        stop = _get_slot_start(_get_slot(stop))
+        cache = _get_availability_cache(self.env.cr.dbname)
+        key = (type_id.id, start, stop, duration, max_depth)
+        stamp = self.env['calendar.occasion.capacity']._get_capacity_stamp(start, stop, type_id)
+        cached = cache.get(key)
+        if cached and cached[0] == stamp:
+            occasion = self.env['calendar.occasion']
+            return [[[occasion.concat(*[occasion.browse(occasion_id) if occasion_id else self._new_counter_occasion(type_id, slot_start)
+                        for occasion_id, slot_start in chain])
+                    for chain in slot]
+                for slot in day]
+            for day in cached[1]]
+        occ_lists = self._find_bookable_occasions(start, stop, duration, type_id, max_depth)
+        cache[key] = (stamp, [[[tuple((occasion.id or False, occasion.start) for occasion in chain)
+                    for chain in slot]
+                for slot in day]
+            for day in occ_lists])
         return occ_lists
 
+    @api.model
+    def _invalidate_availability_cache(self, keys):
+        """Drops cached availability of the given time slots from this worker.
+        :param keys: an iterable of (type_id, start) tuples.
+        """
+        cache = _get_availability_cache(self.env.cr.dbname)
+        # Iterating an LRU yields its values, keys() lists the keys
+        for cache_key in cache.keys():
+            if any(cache_key[0] == type_id and cache_key[1] <= start < cache_key[2] for type_id, start in keys):
+                if cache_key in cache:
+                    del cache[cache_key]
+
+    @classmethod
+    def clear_caches(cls):
+        # Called in every worker when the registry cache sequence changes
+        _availability_cache.pop(cls.pool.db_name, None)
+        super(CalendarOccasion, cls).clear_caches()
+
+    @api.model
+    def _find_bookable_occasions(self, start, stop, duration, type_id, max_depth=1):
+        """Finds chains of free occasions matching a booking, see get_bookable_occasions."""
+        return self._find_bookable_occasions_multi(start, stop, duration, type_id, max_depth)[type_id.id]
+
+    @api.model
+    def _find_bookable_occasions_multi(self, start, stop, duration, type_ids, max_depth=1):
+        """Finds chains of free occasions matching a booking for one or more
+        meeting types, with one capacity query and one occasion query.
+        :returns: a dict mapping type id to bookable occasions in the format
+        of get_bookable_occasions.
+        """
+        # Calculate number of occasions needed to match booking duration
+        no_occasions = int(duration / BASE_DURATION)
+        no_days = max((stop.date() - start.date()).days + 1, 1)
+
+        # Free occasions per type and slot in the window, read from the capacity table
+        free_capacity = self.env['calendar.occasion.capacity']._get_free_capacity_multi(start, stop, type_ids)
+
+        # Whole slots of each day within the window
+        days = []
+        for day in range(no_days):
+            day_date = (start + timedelta(days=day)).date()
+            day_start, day_stop = _get_day_bounds(day_date)
+            days.append(range(_get_slot(max(start, day_start), round_up=True), _get_slot(min(day_stop, stop))))
+
+        runs = []
+        for type_id in type_ids:
+            type_capacity = free_capacity.get(type_id.id, {})
+            for day, day_slots in enumerate(days):
+                # Free capacity per slot of the day
+                capacity = array('H', [min(type_capacity.get(slot, (0, 0))[0], max_depth) for slot in day_slots])
+                for i, depth in _find_slot_runs(capacity, no_occasions):
+                    runs.append((type_id.id, day, day_slots[i:i + no_occasions], depth))
+
+        # Only load the occasions of slots that are part of a chain
+        slots = self._get_free_occasions_by_type_slot({(run[0], slot) for run in runs for slot in run[2]}, max_depth, free_capacity)
+
+        #[[[], []], dag[tidsslot[ocassions]]]
+        res = {type_id.id: [[] for day in range(no_days)] for type_id in type_ids}
+        for type_id, day, chain_slots, depth in runs:
+            occasions = [slots.get((type_id, slot), []) for slot in chain_slots]
+            # The capacity table may be ahead of what this transaction sees
+            depth = min([depth] + [len(occ) for occ in occasions])
+            if depth:
+                res[type_id][day].append([self.env['calendar.occasion'].concat(*[occ[j] for occ in occasions]) for j in range(depth)])
+
+        return res
+
+    @api.model
+    def get_bookable_occasions_multi(self, start, stop, duration, type_ids, channel_ids=None, limit=10, max_depth=1):
+        """Returns the first bookable times of several meeting types merged
+        in time order. All types are searched together, so a mixed search
+        costs the same number of queries as a single type.
+        :param start: Start search as this time.
+        :param stop: Stop search as this time.
+        :param duration: Meeting length.
+        :param type_ids: Meeting types. All types of channel_ids if empty.
+        :param channel_ids: Only search meeting types of these channels.
+        :param limit: Number of suggestions wanted.
+        :param max_depth: Number of bookable occasions per time slot.
+        :returns: a list of dicts with start, stop, type_id and occasion_ids,
+        in the format of calendar.appointment.get_suggestions.
+        """
+        if channel_ids and not type_ids:
+            type_ids = self.env['calendar.appointment.type'].search([('channel', 'in', channel_ids.ids)])
+        elif channel_ids:
+            type_ids = type_ids.filtered(lambda type_id: type_id.channel in channel_ids)
+        if not type_ids:
+            return []
+        start = _get_slot_start(_get_slot(start, round_up=True))
+        stop = _get_slot_start(_get_slot(stop))
+        occ_lists = self._find_bookable_occasions_multi(start, stop, duration, type_ids, max_depth)
+        chains = [chain for days in occ_lists.values() for day in days for slot in day for chain in slot]
+        chains.sort(key=lambda chain: (chain[0].start, chain[0].type_id.id))
+        return [{
+            'start': fields.Datetime.to_string(chain[0].start),
+            'stop': fields.Datetime.to_string(chain[-1].stop),
+            'type_id': chain[0].type_id.id,
+            'occasion_ids': chain.filtered('id').ids,
+        } for chain in chains[:limit]]
+
+    @api.model
+    def _claim_occasion(self, type_id, slot, preferred_id=False, exclude_ids=None):
+        """Locks a free occasion in a time slot. Occasions locked by a
+        concurrent booking are skipped instead of waited for. Occasions
+        of timed out reservations count as free.
+        :param type_id: Meeting type.
+        :param slot: Slot index of the time slot.
+        :param preferred_id: Occasion to claim if it is still free.
+        :param exclude_ids: Occasions that may not be claimed.
+        :returns: the locked occasion, or an empty recordset if the time slot is full.
+        """
+        self.env.cr.execute("""
+            SELECT o.id FROM calendar_occasion o
+            LEFT JOIN calendar_appointment a ON a.id = o.appointment_id
+            WHERE o.type_id = %s AND o.slot = %s AND o.id <> ALL(%s::int[]) AND o.state = 'ok'
+                AND (o.appointment_id IS NULL OR (a.state = 'reserved' AND a.reserved < %s))
+            ORDER BY o.id = %s DESC, o.id
+            LIMIT 1
+            FOR UPDATE OF o SKIP LOCKED""",
+            (type_id.id, slot, exclude_ids or [], datetime.now() - timedelta(seconds=RESERVED_TIMEOUT), preferred_id or 0))
+        row = self.env.cr.fetchone()
+        return self.env['calendar.occasion'].browse(row and row[0])
+
     @api.model
     def reserve_occasion(self, occasion_ids):
-        """Reserves an occasion."""
+        """Reserves an occasion. Every occasion is claimed with a row lock,
+        an occasion taken by a concurrent booking is replaced by another free
+        occasion in the same time slot."""
         start = occasion_ids[0].start
         stop = occasion_ids[len(occasion_ids)-1].stop
         duration = stop.minute - start.minute 
         type_id = self.env.ref('calendar_meeting_type.type_00').id
+        name = occasion_ids[0].type_id.name
+
+        # Occasions standing in for a slot counter are stored when booked
+        counter_occasions = occasion_ids.filtered(lambda o: not o.id)
 
-        # check that occasions are free and unreserved
+        # claim free and unreserved occasions
         free = True
-        for occasion_id in occasion_ids:
-            if (occasion_id.appointment_id and occasion_id.appointment_id.state != 'reserved') or (occasion_id.appointment_id and occasion_id.appointment_id.state == 'reserved' and occasion_id.appointment_id.reserved > datetime.now() - timedelta(seconds=RESERVED_TIMEOUT)):
+        claimed = self.env['calendar.occasion']
+        for occasion_id in occasion_ids - counter_occasions:
+            occasion = self._claim_occasion(occasion_id.type_id, occasion_id.slot, occasion_id.id, claimed.ids)
+            if not occasion:
                 free = False
+                break
+            claimed |= occasion
 
         if free:
             vals = {
-                'name': occasion_ids[0].type_id.name,
+                'name': name,
                 'start': start,
                 'stop': stop,
                 'duration': duration,
@@ -527,16 +1085,17 @@ class CalendarOccasion(models.Model):
                 'state': 'reserved',
                 'location_code': False,
                 'office': False,
-                'occasion_ids': occasion_ids, # I dont think this does anything?
                 'reserved': datetime.now(),
             }
             appointment = self.env['calendar.appointment'].create(vals)
+            # Booking only queues the capacity of its time slots, see _capacity_changed
+            claimed.with_context(defer_capacity=True).write({'appointment_id': appointment.id})
 
-            # relation needs to be set from calendar.occasion?
-            for occasion_id in occasion_ids:
-                occasion_id.appointment_id = appointment.id
-
-            res = appointment
+            if counter_occasions.with_context(defer_capacity=True)._draw_occasions(appointment.id) is False:
+                appointment.unlink()
+                res = False
+            else:
+                res = appointment
         else:
             res = False
 
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    Odoo, Open Source Management Solution, third party addon
+#    Copyright (C) 2004-2015 Vertel AB (<http://vertel.se>).
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+from odoo import models, fields, api, _
+from odoo.tools import split_every
+from odoo.tools.sql import create_index
+from datetime import datetime, timedelta
+import time
+import logging
+
+_logger = logging.getLogger(__name__)
+
+# ARCHIVE_SKIP_COLUMNS: Columns that are not copied from the source table
+ARCHIVE_SKIP_COLUMNS = {'channel'}
+
+def _get_shared_columns(source, archive):
+    """Returns the columns that are stored in both the source and the archive
+    model with the same column type, so that columns added by other modules
+    are archived as long as they are added to both models."""
+    columns = []
+    for name, field in archive._fields.items():
+        source_field = source._fields.get(name)
+        if name in ARCHIVE_SKIP_COLUMNS or not source_field:
+            continue
+        if field.store and field.column_type and source_field.store and source_field.column_type \
+                and field.column_type[0] == source_field.column_type[0]:
+            columns.append(name)
+    return columns
+
+class CalendarAppointmentArchive(models.Model):
+    _name = 'calendar.appointment.archive'
+    _description = "Archived appointment"
+    _order = 'start desc, id'
+
+    name = fields.Char(string='Name', readonly=True)
+    start = fields.Datetime(string='Start', readonly=True, index=True, help="Start date of an appointment")
+    stop = fields.Datetime(string='Stop', readonly=True, help="Stop date of an appointment")
+    duration = fields.Float('Duration', readonly=True)
+    user_id = fields.Many2many(string='Case worker', comodel_name='res.users', relation='calendar_appointment_archive_res_users_rel',
+        column1='appointment_id', column2='user_id', readonly=True, help="Booked case worker")
+    partner_id = fields.Many2many(string='Customer', comodel_name='res.partner', relation='calendar_appointment_archive_res_partner_rel',
+        column1='appointment_id', column2='partner_id', readonly=True, help="Booked customer")
+    state = fields.Selection(selection=[('free', 'Free'),
+                                        ('reserved', 'Reserved'),
+                                        ('confirmed', 'Confirmed'),
+                                        ('canceled', 'Canceled')],
+                                        string='State',
+                                        readonly=True,
+                                        help="Status of the meeting")
+    location_code = fields.Char(string='Location', readonly=True)
+    office = fields.Many2one('res.partner', string="Office", readonly=True)
+    occasion_ids = fields.One2many(comodel_name='calendar.occasion.archive', inverse_name='appointment_id', string="Occasion", readonly=True)
+    type_id = fields.Many2one(string='Type', comodel_name='calendar.appointment.type', readonly=True)
+    channel = fields.Many2one(string='Channel', comodel_name='calendar.channel', readonly=True)
+    reserved = fields.Datetime(string='Reserved', readonly=True, help="Occasions was reserved at this date and time")
+    description = fields.Text(string='Description', readonly=True)
+
+    @api.model
+    def _get_archive_horizon(self):
+        """Returns the time before which appointments and occasions are archived"""
+        days = int(self.env['ir.config_parameter'].sudo().get_param('af_calendar.archive_horizon', default='90'))
+        return datetime.now() - timedelta(days=days)
+
+    @api.model
+    def _archive_records(self, chunk_size=1000):
+        """Moves appointments and occasions that ended before the archive
+        horizon to the archive tables, one chunk at a time. Archived
+        records keep their ids. Run by cron.
+        :param chunk_size: Number of records moved per statement.
+        :returns: a dict with the number of archived appointments and
+        occasions and the time it took in seconds.
+        """
+        started = time.time()
+        horizon = self._get_archive_horizon()
+        res = {'appointments': 0, 'occasions': 0}
+
+        self.env.cr.execute("""
+            SELECT id FROM calendar_appointment
+            WHERE stop < %s
+            ORDER BY id""", (horizon,))
+        appointment_ids = [row[0] for row in self.env.cr.fetchall()]
+        for chunk in split_every(chunk_size, appointment_ids):
+            # Appointments that are being changed are left for the next run
+            self.env.cr.execute("""
+                SELECT id FROM calendar_appointment
+                WHERE id IN %s
+                FOR UPDATE SKIP LOCKED""", (chunk,))
+            chunk = tuple(row[0] for row in self.env.cr.fetchall())
+            if not chunk:
+                continue
+            columns = _get_shared_columns(self.env['calendar.appointment'], self)
+            self.env.cr.execute("""
+                INSERT INTO calendar_appointment_archive ({columns}, channel)
+                SELECT {a_columns}, t.channel FROM calendar_appointment a
+                LEFT JOIN calendar_appointment_type t ON t.id = a.type_id
+                WHERE a.id IN %s""".format(
+                    columns=', '.join(columns),
+                    a_columns=', '.join('a.%s' % column for column in columns)),
+                (chunk,))
+            self.env.cr.execute("""
+                INSERT INTO calendar_appointment_archive_res_users_rel (appointment_id, user_id)
+                SELECT calendar_appointment_id, res_users_id FROM calendar_appointment_res_users_rel
+                WHERE calendar_appointment_id IN %s""", (chunk,))
+            self.env.cr.execute("""
+                INSERT INTO calendar_appointment_archive_res_partner_rel (appointment_id, partner_id)
+                SELECT calendar_appointment_id, res_partner_id FROM calendar_appointment_res_partner_rel
+                WHERE calendar_appointment_id IN %s""", (chunk,))
+            res['occasions'] += self.env['calendar.occasion.archive']._move_occasions("appointment_id IN %s", (chunk,))
+            self.env.cr.execute("DELETE FROM calendar_appointment WHERE id IN %s", (chunk,))
+            res['appointments'] += len(chunk)
+
+        # Occasions that were never booked
+        self.env.cr.execute("""
+            SELECT id FROM calendar_occasion
+            WHERE stop < %s AND appointment_id IS NULL
+            ORDER BY id""", (horizon,))
+        occasion_ids = [row[0] for row in self.env.cr.fetchall()]
+        for chunk in split_every(chunk_size, occasion_ids):
+            res['occasions'] += self.env['calendar.occasion.archive']._move_occasions(
+                "id IN (SELECT id FROM calendar_occasion WHERE id IN %s AND appointment_id IS NULL FOR UPDATE SKIP LOCKED)", (tuple(chunk),))
+
+        # Past time slots can no longer be booked
+        self.env.cr.execute("DELETE FROM calendar_occasion_capacity WHERE start < %s", (horizon,))
+
+        self.env['calendar.appointment'].invalidate_cache()
+        self.env['calendar.occasion'].invalidate_cache()
+        self.env['calendar.occasion.capacity'].invalidate_cache()
+        res['duration'] = time.time() - started
+        _logger.info("Archived %(appointments)s appointments and %(occasions)s occasions in %(duration).2f s" % res)
+        return res
+
+class CalendarOccasionArchive(models.Model):
+    _name = 'calendar.occasion.archive'
+    _description = "Archived occasion"
+    _order = 'start desc, id'
+
+    name = fields.Char(string='Name', readonly=True)
+    start = fields.Datetime(string='Start', readonly=True, index=True, help="Start date of an occasion")
+    stop = fields.Datetime(string='Stop', readonly=True, help="Stop date of an occasion")
+    duration = fields.Float('Duration', readonly=True)
+    appointment_id = fields.Many2one(comodel_name='calendar.appointment.archive', string="Appointment", readonly=True, index=True)
+    type_id = fields.Many2one(comodel_name='calendar.appointment.type', string='Type', readonly=True)
+    channel = fields.Many2one(string='Channel', comodel_name='calendar.channel', readonly=True)
+    additional_booking = fields.Boolean(String='Over booking', readonly=True)
+    user_id = fields.Many2one(string='Case worker', comodel_name='res.users', readonly=True, help="Booked case worker")
+    state = fields.Selection(selection=[('request', 'Awaiting acceptance'),
+                                        ('ok', 'Ready to book'),
+                                        ('fail', 'Denied')],
+                                        string='Occasion state',
+                                        readonly=True,
+                                        help="Status of the meeting")
+
+    @api.model_cr
+    def init(self):
+        # Index for the schedule capacity report
+        create_index(self.env.cr, 'calendar_occasion_archive_type_id_start_index', self._table, ['type_id', 'start'])
+
+    @api.model
+    def _move_occasions(self, where, params):
+        """Moves occasions from calendar_occasion to the archive with a
+        single statement.
+        :param where: SQL condition selecting the occasions to move.
+        :param params: Query parameters of the condition.
+        :returns: the number of moved occasions.
+        """
+        columns = _get_shared_columns(self.env['calendar.occasion'], self)
+        self.env.cr.execute("""
+            WITH moved AS (
+                DELETE FROM calendar_occasion WHERE {where}
+                RETURNING {columns}
+            )
+            INSERT INTO calendar_occasion_archive ({columns}, channel)
+            SELECT {m_columns}, t.channel FROM moved m
+            LEFT JOIN calendar_appointment_type t ON t.id = m.type_id""".format(
+                where=where,
+                columns=', '.join(columns),
+                m_columns=', '.join('m.%s' % column for column in columns)),
+            params)
+        return self.env.cr.rowcount
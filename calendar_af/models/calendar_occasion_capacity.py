@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    Odoo, Open Source Management Solution, third party addon
+#    Copyright (C) 2004-2015 Vertel AB (<http://vertel.se>).
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+from odoo import models, fields, api, _
+from .calendar import _get_slot
+import time
+import logging
+
+_logger = logging.getLogger(__name__)
+
+class CalendarOccasionCapacity(models.Model):
+    _name = 'calendar.occasion.capacity'
+    _description = "Occasion capacity"
+    _order = 'start, type_id'
+
+    start = fields.Datetime(string='Start', required=True, readonly=True, index=True, help="Start of the time slot")
+    type_id = fields.Many2one(comodel_name='calendar.appointment.type', string='Type', required=True, readonly=True, ondelete='cascade')
+    total = fields.Integer(string='Total', readonly=True, help="Number of occasions in this time slot")
+    free = fields.Integer(string='Free', readonly=True, help="Number of bookable occasions without an appointment")
+    reserved = fields.Integer(string='Reserved', readonly=True, help="Number of occasions linked to an appointment")
+    counter = fields.Integer(string='Counter', readonly=True, help="Free occasions held as a count instead of as occasion rows")
+
+    _sql_constraints = [
+        ('type_start_uniq', 'unique(type_id, start)', 'There can only be one capacity per meeting type and time slot.'),
+    ]
+
+    @api.model_cr
+    def init(self):
+        # Every insert and update takes a new version from the sequence, see _get_capacity_stamp
+        self.env.cr.execute("CREATE SEQUENCE IF NOT EXISTS calendar_occasion_capacity_version_seq")
+        self.env.cr.execute("""
+            ALTER TABLE calendar_occasion_capacity
+            ADD COLUMN IF NOT EXISTS version bigint NOT NULL DEFAULT nextval('calendar_occasion_capacity_version_seq')""")
+        # Time slots waiting to be recounted, see _process_queue. Append only and
+        # without a unique constraint so that queueing never conflicts with
+        # another transaction.
+        self.env.cr.execute("""
+            CREATE TABLE IF NOT EXISTS calendar_occasion_capacity_queue (
+                id serial PRIMARY KEY,
+                type_id integer NOT NULL,
+                start timestamp NOT NULL
+            )""")
+        # Populate the table the first time the module is installed or updated
+        self.env.cr.execute("SELECT 1 FROM calendar_occasion_capacity LIMIT 1")
+        if not self.env.cr.fetchone():
+            self.env.cr.execute("SELECT DISTINCT type_id, start FROM calendar_occasion WHERE type_id IS NOT NULL")
+            self._recount_capacity(self.env.cr.fetchall())
+
+    @api.model
+    def _update_capacity(self, keys):
+        """Recounts the occasions of the given time slots right away and
+        queues their days for the daily occupancy. Bookings queue their
+        time slots instead, see calendar.occasion._capacity_changed.
+        :param keys: an iterable of (type_id, start) tuples.
+        """
+        keys = {(type_id, start) for type_id, start in keys if type_id and start}
+        self._recount_capacity(keys)
+        # The daily occupancy is shared by every slot of a day, leave it to the cron
+        self._queue_keys(keys)
+
+    @api.model
+    def _recount_capacity(self, keys):
+        """Recounts the occasions of the given time slots. Free occasions
+        held in the slot counter are included in total and free.
+        :param keys: an iterable of (type_id, start) tuples.
+        """
+        keys = {(type_id, start) for type_id, start in keys if type_id and start}
+        if not keys:
+            return
+        type_ids, starts = zip(*keys)
+        self.env.cr.execute("""
+            INSERT INTO calendar_occasion_capacity (type_id, start, total, free, reserved, counter, create_uid, create_date, write_uid, write_date)
+            SELECT k.type_id, k.start, count(o.id), count(o.id) FILTER (WHERE o.appointment_id IS NULL AND o.state = 'ok'), count(o.appointment_id), 0,
+                %(uid)s, now() AT TIME ZONE 'UTC', %(uid)s, now() AT TIME ZONE 'UTC'
+            FROM unnest(%(type_ids)s::int[], %(starts)s::timestamp[]) AS k(type_id, start)
+            LEFT JOIN calendar_occasion o ON o.type_id = k.type_id AND o.start = k.start
+            GROUP BY k.type_id, k.start
+            ON CONFLICT (type_id, start) DO UPDATE SET
+                total = EXCLUDED.total + calendar_occasion_capacity.counter,
+                free = EXCLUDED.free + calendar_occasion_capacity.counter,
+                reserved = EXCLUDED.reserved,
+                version = nextval('calendar_occasion_capacity_version_seq'),
+                write_uid = EXCLUDED.write_uid,
+                write_date = EXCLUDED.write_date""",
+            {'uid': self.env.uid, 'type_ids': list(type_ids), 'starts': list(starts)})
+        self.invalidate_cache()
+        self.env['calendar.occasion']._invalidate_availability_cache(keys)
+
+    @api.model
+    def _queue_keys(self, keys):
+        """Queues time slots to be recounted by _process_queue and drops
+        them from the availability cache of this worker. Other workers
+        notice the change once the slots have been recounted.
+        :param keys: an iterable of (type_id, start) tuples.
+        """
+        keys = {(type_id, start) for type_id, start in keys if type_id and start}
+        if not keys:
+            return
+        self.env['calendar.occasion']._invalidate_availability_cache(keys)
+        type_ids, starts = zip(*keys)
+        self.env.cr.execute("""
+            INSERT INTO calendar_occasion_capacity_queue (type_id, start)
+            SELECT * FROM unnest(%s::int[], %s::timestamp[])""",
+            (list(type_ids), list(starts)))
+
+    @api.model
+    def _process_queue(self, limit=10000):
+        """Recounts the capacity and the daily occupancy of the queued time
+        slots, limit queued slots at a time. Run by cron, which is the only
+        consumer of the queue.
+        :param limit: Number of queued slots taken per statement.
+        :returns: a dict with the number of processed queue entries and the
+        time it took in seconds.
+        """
+        started = time.time()
+        res = {'queued': 0}
+        while True:
+            self.env.cr.execute("""
+                DELETE FROM calendar_occasion_capacity_queue
+                WHERE id IN (SELECT id FROM calendar_occasion_capacity_queue ORDER BY id LIMIT %s)
+                RETURNING type_id, start""", (limit,))
+            rows = self.env.cr.fetchall()
+            keys = set(rows)
+            self._recount_capacity(keys)
+            self.env['calendar.occasion.daily']._refresh_days(keys)
+            res['queued'] += len(rows)
+            if len(rows) < limit:
+                break
+        res['duration'] = time.time() - started
+        _logger.debug("Processed %(queued)s queued time slots in %(duration).2f s" % res)
+        return res
+
+    @api.model
+    def _set_counters(self, counters):
+        """Sets the number of free occasions held as a count per time slot.
+        :param counters: a dict mapping (type_id, start) to a counter.
+        """
+        if not counters:
+            return
+        keys = list(counters)
+        self.env.cr.execute("""
+            INSERT INTO calendar_occasion_capacity (type_id, start, total, free, reserved, counter, create_uid, create_date, write_uid, write_date)
+            SELECT k.type_id, k.start, 0, 0, 0, k.counter,
+                %(uid)s, now() AT TIME ZONE 'UTC', %(uid)s, now() AT TIME ZONE 'UTC'
+            FROM unnest(%(type_ids)s::int[], %(starts)s::timestamp[], %(counters)s::int[]) AS k(type_id, start, counter)
+            ON CONFLICT (type_id, start) DO UPDATE SET
+                counter = EXCLUDED.counter,
+                version = nextval('calendar_occasion_capacity_version_seq')""",
+            {
+                'uid': self.env.uid,
+                'type_ids': [key[0] for key in keys],
+                'starts': [key[1] for key in keys],
+                'counters': [counters[key] for key in keys],
+            })
+        self._update_capacity(keys)
+
+    @api.model
+    def _draw_counters(self, keys):
+        """Takes one free occasion from the counter of each given time slot.
+        Either all counters are drawn from or none of them.
+        :param keys: an iterable of (type_id, start) tuples.
+        :returns: True if every time slot had a free occasion left.
+        """
+        keys = set(keys)
+        if not keys:
+            return True
+        type_ids, starts = zip(*keys)
+        self.env.cr.execute("""
+            UPDATE calendar_occasion_capacity c SET counter = c.counter - 1, free = c.free - 1, total = c.total - 1,
+                version = nextval('calendar_occasion_capacity_version_seq')
+            FROM unnest(%s::int[], %s::timestamp[]) AS k(type_id, start)
+            WHERE c.type_id = k.type_id AND c.start = k.start AND c.counter > 0
+            RETURNING c.id""", (list(type_ids), list(starts)))
+        drawn = [row[0] for row in self.env.cr.fetchall()]
+        if len(drawn) < len(keys):
+            # Give back what we took
+            if drawn:
+                self.env.cr.execute("""
+                    UPDATE calendar_occasion_capacity SET counter = counter + 1, free = free + 1, total = total + 1,
+                        version = nextval('calendar_occasion_capacity_version_seq')
+                    WHERE id IN %s""", (tuple(drawn),))
+            res = False
+        else:
+            res = True
+        self.invalidate_cache()
+        return res
+
+    @api.model
+    def _get_capacity_stamp(self, start, stop, type_id):
+        """Returns a value that changes whenever a capacity row of a meeting
+        type within a window is created, changed or deleted. Every write
+        gives the row a higher version, so the sum of the versions changes
+        even when a transaction that took its version earlier commits later."""
+        self.env.cr.execute("""
+            SELECT count(id), sum(version) FROM calendar_occasion_capacity
+            WHERE type_id = %s AND start >= %s AND start < %s""",
+            (type_id.id, start, stop))
+        return self.env.cr.fetchone()
+
+    @api.model
+    def _get_free_capacity(self, start, stop, type_id):
+        """Returns the number of free occasions per time slot of a meeting type.
+        :param start: Start of the window.
+        :param stop: End of the window.
+        :param type_id: Meeting type.
+        :returns: a dict mapping slot index to a (free, counter) tuple.
+        """
+        return self._get_free_capacity_multi(start, stop, type_id).get(type_id.id, {})
+
+    @api.model
+    def _get_free_capacity_multi(self, start, stop, type_ids):
+        """Returns the number of free occasions per time slot of one or more
+        meeting types with a single query.
+        :returns: a dict mapping type id to a dict mapping slot index to a
+        (free, counter) tuple.
+        """
+        if not type_ids:
+            return {}
+        self.env.cr.execute("""
+            SELECT type_id, start, free, counter FROM calendar_occasion_capacity
+            WHERE type_id IN %s AND start >= %s AND start < %s AND free > 0""",
+            (tuple(type_ids.ids), start, stop))
+        res = {}
+        for type_id, start, free, counter in self.env.cr.fetchall():
+            res.setdefault(type_id, {})[_get_slot(start)] = (free, counter)
+        return res
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    Odoo, Open Source Management Solution, third party addon
+#    Copyright (C) 2004-2015 Vertel AB (<http://vertel.se>).
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+from odoo import models, fields, api, _
+from .calendar import LOCAL_TZ
+import pytz
+import logging
+
+_logger = logging.getLogger(__name__)
+
+class CalendarOccasionDaily(models.Model):
+    _name = 'calendar.occasion.daily'
+    _description = "Daily occupancy"
+    _order = 'day, type_id'
+
+    day = fields.Date(string='Day', required=True, readonly=True, index=True, help="Day in local time")
+    type_id = fields.Many2one(comodel_name='calendar.appointment.type', string='Type', required=True, readonly=True, ondelete='cascade')
+    channel = fields.Many2one(string='Channel', comodel_name='calendar.channel', readonly=True)
+    free = fields.Integer(string='Free', readonly=True, help="Number of bookable occasions without an appointment")
+    booked = fields.Integer(string='Booked', readonly=True, help="Number of scheduled occasions linked to an appointment")
+    overbooked = fields.Integer(string='Overbooked', readonly=True, help="Number of additional occasions linked to an appointment")
+
+    _sql_constraints = [
+        ('type_day_uniq', 'unique(type_id, day)', 'There can only be one daily occupancy per meeting type and day.'),
+    ]
+
+    @api.model_cr
+    def init(self):
+        # Populate the table the first time the module is installed or updated.
+        # The counts include the slot counters, so calendar_occasion_capacity is
+        # initialized first, see the import order in models/__init__.py
+        self.env.cr.execute("SELECT 1 FROM calendar_occasion_daily LIMIT 1")
+        if not self.env.cr.fetchone():
+            self.env.cr.execute("SELECT DISTINCT type_id, start FROM calendar_occasion WHERE type_id IS NOT NULL")
+            self._refresh_days(self.env.cr.fetchall())
+
+    @api.model
+    def _refresh_days(self, keys):
+        """Recounts the occupancy of the days of the given time slots.
+        Free occasions held in slot counters count as free.
+        :param keys: an iterable of (type_id, start) tuples.
+        """
+        local_tz = pytz.timezone(LOCAL_TZ)
+        days = {(type_id, pytz.utc.localize(start).astimezone(local_tz).date()) for type_id, start in keys if type_id and start}
+        if not days:
+            return
+        type_ids, dates = zip(*days)
+        self.env.cr.execute("""
+            WITH day AS (
+                SELECT k.type_id, k.day,
+                    (k.day::timestamp AT TIME ZONE %(tz)s) AT TIME ZONE 'UTC' AS day_start,
+                    ((k.day + 1)::timestamp AT TIME ZONE %(tz)s) AT TIME ZONE 'UTC' AS day_stop
+                FROM unnest(%(type_ids)s::int[], %(days)s::date[]) AS k(type_id, day)
+            ), occupancy AS (
+                SELECT d.type_id, d.day,
+                    count(o.id) FILTER (WHERE o.appointment_id IS NULL AND o.state = 'ok') AS free,
+                    count(o.id) FILTER (WHERE o.appointment_id IS NOT NULL AND o.additional_booking IS NOT TRUE) AS booked,
+                    count(o.id) FILTER (WHERE o.appointment_id IS NOT NULL AND o.additional_booking IS TRUE) AS overbooked
+                FROM day d
+                LEFT JOIN calendar_occasion o ON o.type_id = d.type_id AND o.start >= d.day_start AND o.start < d.day_stop
+                GROUP BY d.type_id, d.day
+            ), counter AS (
+                SELECT d.type_id, d.day, coalesce(sum(c.counter), 0) AS counter
+                FROM day d
+                LEFT JOIN calendar_occasion_capacity c ON c.type_id = d.type_id AND c.start >= d.day_start AND c.start < d.day_stop
+                GROUP BY d.type_id, d.day
+            )
+            INSERT INTO calendar_occasion_daily (day, type_id, channel, free, booked, overbooked, create_uid, create_date, write_uid, write_date)
+            SELECT o.day, o.type_id, t.channel, o.free + c.counter, o.booked, o.overbooked,
+                %(uid)s, now() AT TIME ZONE 'UTC', %(uid)s, now() AT TIME ZONE 'UTC'
+            FROM occupancy o
+            JOIN counter c ON c.type_id = o.type_id AND c.day = o.day
+            JOIN calendar_appointment_type t ON t.id = o.type_id
+            ON CONFLICT (type_id, day) DO UPDATE SET
+                channel = EXCLUDED.channel,
+                free = EXCLUDED.free,
+                booked = EXCLUDED.booked,
+                overbooked = EXCLUDED.overbooked,
+                write_uid = EXCLUDED.write_uid,
+                write_date = EXCLUDED.write_date""",
+            {'uid': self.env.uid, 'tz': LOCAL_TZ, 'type_ids': list(type_ids), 'days': list(dates)})
+        self.invalidate_cache()
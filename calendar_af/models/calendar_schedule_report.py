@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    Odoo, Open Source Management Solution, third party addon
+#    Copyright (C) 2004-2015 Vertel AB (<http://vertel.se>).
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+from odoo import models, fields, api, tools, _
+import logging
+
+_logger = logging.getLogger(__name__)
+
+class CalendarScheduleReport(models.Model):
+    _name = 'calendar.schedule.report'
+    _description = "Schedule capacity report"
+    _auto = False
+    _order = 'start, type_id'
+
+    start = fields.Datetime(string='Start', readonly=True)
+    stop = fields.Datetime(string='Stop', readonly=True)
+    type_id = fields.Many2one(comodel_name='calendar.appointment.type', string='Type', readonly=True)
+    channel = fields.Many2one(string='Channel', comodel_name='calendar.channel', readonly=True)
+    scheduled_agents = fields.Integer(string='Scheduled agents', readonly=True)
+    forecasted_agents = fields.Integer(string='Forecasted agents', readonly=True)
+    forecast_gap = fields.Integer(string='Forecast gap', readonly=True, help="Scheduled agents minus forecasted agents")
+    free = fields.Integer(string='Free', readonly=True, help="Number of bookable occasions without an appointment")
+    booked = fields.Integer(string='Booked', readonly=True, help="Number of scheduled occasions linked to an appointment")
+    overbooked = fields.Integer(string='Overbooked', readonly=True, help="Number of additional occasions linked to an appointment")
+    utilization = fields.Float(string='Utilization (%)', readonly=True, group_operator='avg', help="Booked occasions per scheduled agent")
+    overbooking_ratio = fields.Float(string='Overbooking (%)', readonly=True, group_operator='avg', help="Share of the booked occasions that are additional")
+
+    @api.model_cr
+    def init(self):
+        tools.drop_view_if_exists(self.env.cr, self._table)
+        # Occasions are counted per schedule through the (type_id, slot) index,
+        # archived occasions have no slot and are matched on (type_id, start)
+        self.env.cr.execute("""
+            CREATE OR REPLACE VIEW calendar_schedule_report AS (
+                SELECT
+                    s.id,
+                    s.start,
+                    s.stop,
+                    s.type_id,
+                    s.channel,
+                    s.scheduled_agents,
+                    s.forecasted_agents,
+                    coalesce(s.scheduled_agents, 0) - coalesce(s.forecasted_agents, 0) AS forecast_gap,
+                    o.free + coalesce(c.counter, 0) AS free,
+                    o.booked,
+                    o.overbooked,
+                    CASE WHEN s.scheduled_agents > 0
+                        THEN 100.0 * o.booked / s.scheduled_agents ELSE 0 END AS utilization,
+                    CASE WHEN o.booked + o.overbooked > 0
+                        THEN 100.0 * o.overbooked / (o.booked + o.overbooked) ELSE 0 END AS overbooking_ratio
+                FROM calendar_schedule s
+                LEFT JOIN LATERAL (
+                    SELECT
+                        count(id) FILTER (WHERE appointment_id IS NULL AND state = 'ok') AS free,
+                        count(id) FILTER (WHERE appointment_id IS NOT NULL AND additional_booking IS NOT TRUE) AS booked,
+                        count(id) FILTER (WHERE appointment_id IS NOT NULL AND additional_booking IS TRUE) AS overbooked
+                    FROM (
+                        SELECT id, appointment_id, additional_booking, state FROM calendar_occasion
+                        WHERE type_id = s.type_id AND slot = s.slot
+                        UNION ALL
+                        SELECT id, appointment_id, additional_booking, state FROM calendar_occasion_archive
+                        WHERE type_id = s.type_id AND start = s.start
+                    ) occasion
+                ) o ON TRUE
+                LEFT JOIN calendar_occasion_capacity c ON c.type_id = s.type_id AND c.start = s.start
+            )""")
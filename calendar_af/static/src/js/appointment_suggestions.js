@@ -0,0 +1,92 @@
+odoo.define('calendar_af.appointment_suggestions', function (require) {
+"use strict";
+
+var field_utils = require('web.field_utils');
+var Widget = require('web.Widget');
+var widget_registry = require('web.widget_registry');
+
+/**
+ * Lists suggested dates of a saved appointment. The pages are fetched with
+ * calendar.appointment.get_suggestions and nothing is written until a
+ * suggestion is booked with calendar.appointment.select_suggestion.
+ */
+var AppointmentSuggestions = Widget.extend({
+    template: 'calendar_af.AppointmentSuggestions',
+    events: {
+        'click .o_suggestions_update': '_onUpdate',
+        'click .o_suggestions_previous': '_onPrevious',
+        'click .o_suggestions_next': '_onNext',
+        'click .o_suggestion_select': '_onSelect',
+    },
+
+    init: function (parent, record) {
+        this._super.apply(this, arguments);
+        this.res_id = record.res_id;
+        // Tokens of the pages before the current one
+        this.tokens = [];
+        this.page = {suggestions: [], token: false};
+    },
+
+    willStart: function () {
+        return $.when(this._super.apply(this, arguments), this._fetch(false));
+    },
+
+    formatDatetime: function (value) {
+        return field_utils.format.datetime(field_utils.parse.datetime(value, null, {isUTC: true}), null, {timezone: true});
+    },
+
+    _fetch: function (token) {
+        var self = this;
+        if (!this.res_id) {
+            return $.when();
+        }
+        return this._rpc({
+            model: 'calendar.appointment',
+            method: 'get_suggestions',
+            args: [[this.res_id], token],
+        }).then(function (page) {
+            self.page = page;
+        });
+    },
+
+    _show: function (token) {
+        var self = this;
+        return this._fetch(token).then(function () {
+            self.renderElement();
+        });
+    },
+
+    _onUpdate: function () {
+        this.tokens = [];
+        this._show(false);
+    },
+
+    _onPrevious: function () {
+        this.tokens.pop();
+        this._show(this.tokens.length ? this.tokens[this.tokens.length - 1] : false);
+    },
+
+    _onNext: function () {
+        if (this.page.token) {
+            this.tokens.push(this.page.token);
+            this._show(this.page.token);
+        }
+    },
+
+    _onSelect: function (ev) {
+        var self = this;
+        var suggestion = this.page.suggestions[$(ev.currentTarget).data('index')];
+        this._rpc({
+            model: 'calendar.appointment',
+            method: 'select_suggestion',
+            args: [[this.res_id], suggestion],
+        }).then(function () {
+            self.trigger_up('reload');
+        });
+    },
+});
+
+widget_registry.add('appointment_suggestions', AppointmentSuggestions);
+
+return AppointmentSuggestions;
+});